@@ -1,4 +1,9 @@
 import os
+import shutil
+import tempfile
+
+import pytest
+from django.test import override_settings
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 root_dir_content = os.listdir(BASE_DIR)
@@ -37,3 +42,14 @@ pytest_plugins = [
     'tests.fixtures.fixture_user',
     'tests.fixtures.fixture_data',
 ]
+
+
+@pytest.fixture(autouse=True)
+def temp_media_root():
+    """Файлы, созданные тестами, не попадают в MEDIA_ROOT проекта."""
+    media_root = tempfile.mkdtemp()
+    try:
+        with override_settings(MEDIA_ROOT=media_root):
+            yield media_root
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
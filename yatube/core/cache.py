@@ -0,0 +1,399 @@
+"""Двухуровневый кэш, общий для всех процессов одной машины.
+
+L1 — ограниченный LRU в памяти процесса, L2 — файл SQLite в режиме WAL,
+его видят все воркеры машины. Каждое изменение L2 дописывает ключ
+в журнал инвалидаций, а номер последней строки журнала публикуется
+в маленьком файле, который процессы отображают в память (mmap).
+Перед чтением из L1 процесс сравнивает этот номер со своим и, если он
+сдвинулся, выбрасывает из L1 ключи из новых строк журнала. Своих
+изменений процесс в L1 не пишет: L1 наполняется только чтениями L2.
+Внешние сервисы не нужны.
+"""
+import mmap
+import os
+import pickle
+import sqlite3
+import stat
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.exceptions import ImproperlyConfigured
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS cache_entries ('
+    'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)',
+    'CREATE TABLE IF NOT EXISTS cache_invalidations ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT)',
+)
+# Строка журнала без ключа — сброс всего кэша (clear).
+CLEAR_ALL = None
+COUNTER = struct.Struct('q')
+CULL_EVERY = 100
+
+
+def private_dir(path):
+    """Создаёт каталог, доступный только текущему пользователю.
+
+    Существующий каталог должен принадлежать ему же: кто может
+    подложить файл в кэш, тот исполнит код при `pickle.loads`.
+    Лишние права у своего каталога снимаются.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise ImproperlyConfigured(f'{path} не является каталогом.')
+    if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+        raise ImproperlyConfigured(
+            f'Каталог {path} принадлежит другому пользователю.'
+        )
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+
+class TwoTierCache(BaseCache):
+    """Бэкенд `django.core.cache`: LRU процесса поверх общего SQLite.
+
+    LOCATION — путь к файлу SQLite, обязателен. OPTIONS, кроме стандартных
+    MAX_ENTRIES и CULL_FREQUENCY (они относятся к L2):
+    L1_MAX_ENTRIES — размер LRU процесса, L1_TIMEOUT — сколько секунд
+    запись живёт в L1 независимо от журнала, INVALIDATION_LOG_SIZE —
+    сколько последних строк журнала хранить.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS') or {}
+        if not location:
+            raise ImproperlyConfigured('TwoTierCache: не задан LOCATION.')
+        self._path = location
+        self._l1_max_entries = int(options.get('L1_MAX_ENTRIES', 1000))
+        self._l1_timeout = options.get('L1_TIMEOUT', 300)
+        self._log_size = int(options.get('INVALIDATION_LOG_SIZE', 10000))
+        self._l1 = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._counter = None
+        self._seen_id = 0
+        self._seen_counter = 0
+        self._writes = 0
+
+    # Соединения и счётчик журнала — свои в каждом процессе.
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self._path, timeout=30, isolation_level=None
+        )
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    def _open_counter(self):
+        fd = os.open(self._path + '-counter', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < COUNTER.size:
+                os.ftruncate(fd, COUNTER.size)
+            return mmap.mmap(fd, COUNTER.size)
+        finally:
+            os.close(fd)
+
+    def _connection(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # После fork L1 родителя не сверялся с журналом.
+                    self._l1.clear()
+                    private_dir(os.path.dirname(self._path))
+                    self._counter = self._open_counter()
+                    connection = self._connect()
+                    self._seen_counter = self._read_counter()
+                    self._seen_id = connection.execute(
+                        'SELECT COALESCE(MAX(id), 0) '
+                        'FROM cache_invalidations'
+                    ).fetchone()[0]
+                    self._local.connection = (pid, connection)
+                    self._pid = pid
+        opened = getattr(self._local, 'connection', None)
+        if opened is None or opened[0] != pid:
+            opened = (pid, self._connect())
+            self._local.connection = opened
+        return opened[1]
+
+    def _read_counter(self):
+        return COUNTER.unpack_from(self._counter, 0)[0]
+
+    def _publish(self, log_id):
+        if log_id > self._read_counter():
+            COUNTER.pack_into(self._counter, 0, log_id)
+
+    # L1.
+
+    def _sync(self, connection):
+        """Выбрасывает из L1 ключи, изменённые с прошлой сверки."""
+        counter = self._read_counter()
+        if counter == self._seen_counter:
+            return
+        with self._lock:
+            rows = connection.execute(
+                'SELECT id, key FROM cache_invalidations WHERE id > ? '
+                'ORDER BY id',
+                (self._seen_id,),
+            ).fetchall()
+            if rows and rows[0][0] != self._seen_id + 1:
+                # Нужные строки журнала уже удалены: L1 не сверить.
+                self._l1.clear()
+            for _, key in rows:
+                if key is CLEAR_ALL:
+                    self._l1.clear()
+                else:
+                    self._l1.pop(key, None)
+            if rows:
+                self._seen_id = rows[-1][0]
+            self._seen_counter = counter
+
+    def _l1_get(self, key, now):
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= now:
+                del self._l1[key]
+                return None
+            self._l1.move_to_end(key)
+            return entry[0]
+
+    def _l1_put(self, key, pickled, expires, seen_id, now):
+        if self._l1_timeout is not None:
+            limit = now + self._l1_timeout
+            expires = limit if expires is None else min(expires, limit)
+        with self._lock:
+            # Журнал сверяли после чтения L2: значение могло устареть.
+            if self._seen_id != seen_id:
+                return
+            self._l1[key] = (pickled, expires)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self._l1_max_entries:
+                self._l1.popitem(last=False)
+
+    def _forget(self, keys):
+        with self._lock:
+            for key in keys:
+                self._l1.pop(key, None)
+
+    # L2.
+
+    def _write(self, keys, operation):
+        """Выполняет `operation(connection)` в транзакции L2.
+
+        `operation` возвращает пару (результат, изменилось ли что-то);
+        об изменённых ключах узнают остальные процессы.
+        """
+        connection = self._connection()
+        self._forget(key for key in keys if key is not CLEAR_ALL)
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result, changed = operation(connection)
+            log_id = None
+            if changed:
+                connection.executemany(
+                    'INSERT INTO cache_invalidations (key) VALUES (?)',
+                    [(key,) for key in keys],
+                )
+                log_id = connection.execute(
+                    'SELECT MAX(id) FROM cache_invalidations'
+                ).fetchone()[0]
+                self._maintain(connection, log_id)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        if log_id is not None:
+            self._publish(log_id)
+        return result
+
+    def _maintain(self, connection, log_id):
+        connection.execute(
+            'DELETE FROM cache_invalidations WHERE id <= ?',
+            (log_id - self._log_size,),
+        )
+        self._writes += 1
+        if self._writes % CULL_EVERY == 0:
+            self._cull(connection)
+
+    def _cull(self, connection):
+        connection.execute(
+            'DELETE FROM cache_entries WHERE expires <= ?', (time.time(),)
+        )
+        count = connection.execute(
+            'SELECT COUNT(*) FROM cache_entries'
+        ).fetchone()[0]
+        if count <= self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            connection.execute('DELETE FROM cache_entries')
+            return
+        connection.execute(
+            'DELETE FROM cache_entries WHERE rowid IN ('
+            'SELECT rowid FROM cache_entries ORDER BY rowid LIMIT ?)',
+            (count // self._cull_frequency,),
+        )
+
+    @staticmethod
+    def _alive(row, now):
+        return row is not None and (row[-1] is None or row[-1] > now)
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    # API кэша.
+
+    def get(self, key, default=None, version=None):
+        return self.get_many([key], version=version).get(key, default)
+
+    def get_many(self, keys, version=None):
+        keys = {self._key(key, version): key for key in keys}
+        if not keys:
+            return {}
+        connection = self._connection()
+        self._sync(connection)
+        now = time.time()
+        found, missing = {}, []
+        for key, original in keys.items():
+            pickled = self._l1_get(key, now)
+            if pickled is None:
+                missing.append(key)
+            else:
+                found[original] = pickle.loads(pickled)
+        if not missing:
+            return found
+        seen_id = self._seen_id
+        placeholders = ', '.join('?' * len(missing))
+        rows = connection.execute(
+            'SELECT key, value, expires FROM cache_entries '
+            f'WHERE key IN ({placeholders})',
+            missing,
+        ).fetchall()
+        self._sync(connection)
+        for key, pickled, expires in rows:
+            if not self._alive((expires,), now):
+                continue
+            self._l1_put(key, pickled, expires, seen_id, now)
+            found[keys[key]] = pickle.loads(pickled)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout=timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self.get_backend_timeout(timeout)
+        rows = [
+            (
+                self._key(key, version),
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                expires,
+            )
+            for key, value in data.items()
+        ]
+
+        def operation(connection):
+            connection.executemany(
+                'INSERT OR REPLACE INTO cache_entries (key, value, expires) '
+                'VALUES (?, ?, ?)',
+                rows,
+            )
+            return [], bool(rows)
+
+        if rows:
+            self._write([row[0] for row in rows], operation)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self.get_backend_timeout(timeout)
+
+        def operation(connection):
+            row = connection.execute(
+                'SELECT expires FROM cache_entries WHERE key = ?', (key,)
+            ).fetchone()
+            if self._alive(row, time.time()):
+                return False, False
+            connection.execute(
+                'INSERT OR REPLACE INTO cache_entries (key, value, expires) '
+                'VALUES (?, ?, ?)',
+                (key, pickled, expires),
+            )
+            return True, True
+
+        return self._write([key], operation)
+
+    def incr(self, key, delta=1, version=None):
+        key = self._key(key, version)
+
+        def operation(connection):
+            row = connection.execute(
+                'SELECT value, expires FROM cache_entries WHERE key = ?',
+                (key,),
+            ).fetchone()
+            if not self._alive(row, time.time()):
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(row[0]) + delta
+            connection.execute(
+                'UPDATE cache_entries SET value = ? WHERE key = ?',
+                (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), key),
+            )
+            return value, True
+
+        return self._write([key], operation)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        expires = self.get_backend_timeout(timeout)
+
+        def operation(connection):
+            updated = connection.execute(
+                'UPDATE cache_entries SET expires = ? '
+                'WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                (expires, key, time.time()),
+            ).rowcount
+            return bool(updated), bool(updated)
+
+        return self._write([key], operation)
+
+    def has_key(self, key, version=None):
+        return self.get_many([key], version=version) != {}
+
+    def delete(self, key, version=None):
+        self.delete_many([key], version=version)
+
+    def delete_many(self, keys, version=None):
+        keys = [self._key(key, version) for key in keys]
+
+        def operation(connection):
+            connection.executemany(
+                'DELETE FROM cache_entries WHERE key = ?',
+                [(key,) for key in keys],
+            )
+            return None, bool(keys)
+
+        if keys:
+            self._write(keys, operation)
+
+    def clear(self):
+        with self._lock:
+            self._l1.clear()
+
+        def operation(connection):
+            connection.execute('DELETE FROM cache_entries')
+            return None, True
+
+        self._write([CLEAR_ALL], operation)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core import singleflight
+
+
+class Command(BaseCommand):
+    help = 'Показывает, сколько перестроений кэша склеил single flight.'
+
+    def handle(self, *args, **options):
+        for name, value in singleflight.stats().items():
+            self.stdout.write(f'{name}: {value}')
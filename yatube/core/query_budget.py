@@ -0,0 +1,128 @@
+"""Бюджеты SQL-запросов на представление.
+
+`QueryBudgetMiddleware` считает запросы запроса, их суммарное время
+и повторы одного вида (тот же SQL с точностью до параметров и длины
+списков `IN`) — признак N+1. Итоги уходят в заголовки ответа
+`X-DB-Queries`, `X-DB-Time` (мс), `X-DB-Duplicates` и в лог.
+
+Представление объявляет бюджет декоратором `@query_budget(queries=3)`.
+Превышение помечается заголовком `X-Query-Budget: exceeded`
+и предупреждением в логе, а при `QUERY_BUDGET_STRICT` (включён
+в тестах) число запросов и повторов сверх бюджета — исключение
+`QueryBudgetExceeded`, и тест падает. Время в тестах не проверяется:
+оно зависит от машины.
+"""
+import logging
+import re
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+IN_LIST = re.compile(r'\((?:%s, )*%s\)')
+# Точки сохранения транзакций — не запросы к данным.
+SAVEPOINTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+    def __init__(self, queries=None, duplicates=None, db_time=None):
+        self.queries = queries
+        self.duplicates = duplicates
+        self.db_time = db_time
+
+
+def query_budget(queries=None, duplicates=None, db_time=None):
+    """Бюджет представления: запросов, повторов и секунд в базе."""
+    budget = Budget(queries, duplicates, db_time)
+
+    def decorator(view_func):
+        view_func.query_budget = budget
+        return view_func
+
+    return decorator
+
+
+class QueryStats:
+    """Запросы, их время и виды за один HTTP-запрос."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.shapes = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.startswith(SAVEPOINTS):
+            return execute(sql, params, many, context)
+        started = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.monotonic() - started
+            self.queries += 1
+            shape = IN_LIST.sub('(%s)', sql)
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    @property
+    def duplicates(self):
+        return self.queries - len(self.shapes)
+
+    def repeated(self):
+        return [shape for shape, count in self.shapes.items() if count > 1]
+
+
+def _over(value, limit):
+    return limit is not None and value > limit
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = QueryStats()
+        request.query_budget = None
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        response['X-DB-Queries'] = str(stats.queries)
+        response['X-DB-Time'] = f'{stats.db_time * 1000:.1f}'
+        response['X-DB-Duplicates'] = str(stats.duplicates)
+        logger.debug(
+            '%s: %d запросов, %.1f мс, повторов %d', request.path,
+            stats.queries, stats.db_time * 1000, stats.duplicates,
+        )
+        budget = request.query_budget
+        if budget is not None:
+            self.check(request, response, stats, budget)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = getattr(view_func, 'query_budget', None)
+
+    def check(self, request, response, stats, budget):
+        broken = _over(stats.queries, budget.queries) or _over(
+            stats.duplicates, budget.duplicates
+        )
+        if not broken and not _over(stats.db_time, budget.db_time):
+            response['X-Query-Budget'] = 'ok'
+            return
+        response['X-Query-Budget'] = 'exceeded'
+        view_name = getattr(request.resolver_match, 'view_name', request.path)
+        message = (
+            f'{view_name}: {stats.queries} запросов '
+            f'(бюджет {budget.queries}), повторов {stats.duplicates} '
+            f'(бюджет {budget.duplicates}), '
+            f'{stats.db_time * 1000:.1f} мс (бюджет {budget.db_time} с); '
+            f'повторяются: {stats.repeated()}'
+        )
+        logger.warning('Превышен бюджет запросов: %s', message)
+        if broken and getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(message)
@@ -0,0 +1,151 @@
+"""Склейка одновременных перестроений кэша (single flight).
+
+Когда запись кэша пропала, перестраивает её только один запрос,
+остальные недолго ждут и читают готовый результат. Блокировка
+действует между потоками (threading.Lock) и между процессами
+одной машины (flock на файле-полосе в общем каталоге
+`SINGLEFLIGHT_LOCK_DIR`, закрытом от других пользователей).
+"""
+import hashlib
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+from core.cache import private_dir
+
+try:
+    import fcntl
+except ImportError:  # Windows: склеиваем только потоки процесса
+    fcntl = None
+
+LOCK_STRIPES = 256
+WAIT_TIMEOUT = getattr(settings, 'SINGLEFLIGHT_WAIT_TIMEOUT', 2.0)
+POLL_INTERVAL = 0.01
+
+STAT_NAMES = ('rebuilds', 'waiters', 'coalesced', 'timeouts')
+
+_thread_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+_lock_files = {}
+_lock_files_guard = threading.Lock()
+
+
+def _stripe(key):
+    digest = hashlib.sha1(key.encode()).digest()
+    return int.from_bytes(digest[:4], 'big') % LOCK_STRIPES
+
+
+def _lock_dir():
+    lock_dir = getattr(settings, 'SINGLEFLIGHT_LOCK_DIR', None)
+    if not lock_dir:
+        raise ImproperlyConfigured('Не задан SINGLEFLIGHT_LOCK_DIR.')
+    return private_dir(lock_dir)
+
+
+def _lock_file(stripe):
+    """Файл полосы, открытый в текущем процессе (после fork — заново)."""
+    pid = os.getpid()
+    with _lock_files_guard:
+        opened = _lock_files.get(stripe)
+        if opened is None or opened[0] != pid:
+            path = os.path.join(_lock_dir(), f'{stripe:03d}.lock')
+            opened = (pid, open(path, 'a'))
+            _lock_files[stripe] = opened
+        return opened[1]
+
+
+def _try_flock(stripe):
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(_lock_file(stripe), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def _unflock(stripe):
+    if fcntl is not None:
+        fcntl.flock(_lock_file(stripe), fcntl.LOCK_UN)
+
+
+class KeyLock:
+    """Блокировка ключа сразу для потоков и для процессов машины."""
+
+    def __init__(self, key):
+        self.stripe = _stripe(key)
+        self.thread_lock = _thread_locks[self.stripe]
+
+    def acquire(self, timeout=None):
+        """Берёт блокировку; `timeout=0` — попытка без ожидания."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if timeout == 0:
+            locked = self.thread_lock.acquire(blocking=False)
+        else:
+            locked = self.thread_lock.acquire(
+                timeout=-1 if timeout is None else timeout
+            )
+        if not locked:
+            return False
+        while not _try_flock(self.stripe):
+            if deadline is not None and time.monotonic() >= deadline:
+                self.thread_lock.release()
+                return False
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    def release(self):
+        _unflock(self.stripe)
+        self.thread_lock.release()
+
+
+def _count(name):
+    key = f'singleflight:{name}'
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def stats():
+    """Счётчики склейки по всем процессам, что делят кэш."""
+    values = cache.get_many([f'singleflight:{name}' for name in STAT_NAMES])
+    return {
+        name: values.get(f'singleflight:{name}', 0) for name in STAT_NAMES
+    }
+
+
+def coalesce(key, lookup, rebuild, wait=None):
+    """Возвращает `lookup()`, а при промахе — результат одного `rebuild()`.
+
+    Первый промахнувшийся вызывает `rebuild()`, остальные ждут его до
+    `wait` секунд и снова вызывают `lookup()`. Если дождаться не вышло
+    или результат не попал в кэш, запрос перестраивает сам.
+    """
+    wait = WAIT_TIMEOUT if wait is None else wait
+    lock = KeyLock(key)
+    if lock.acquire(timeout=0):
+        try:
+            value = lookup()
+            if value is None:
+                _count('rebuilds')
+                value = rebuild()
+            return value
+        finally:
+            lock.release()
+
+    _count('waiters')
+    if lock.acquire(timeout=wait):
+        lock.release()
+        value = lookup()
+        if value is not None:
+            _count('coalesced')
+            return value
+    else:
+        _count('timeouts')
+    _count('rebuilds')
+    return rebuild()
@@ -1,5 +1,25 @@
+import multiprocessing
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.test import (Client, RequestFactory, SimpleTestCase, TestCase,
+                         override_settings)
+from django.urls import reverse
+
+from core import singleflight
+from core.cache import TwoTierCache, private_dir
+from core.query_budget import (QueryBudgetExceeded, QueryBudgetMiddleware,
+                               query_budget)
 
 User = get_user_model()
 
@@ -13,8 +33,244 @@ class CoreViewsTests(TestCase):
         # Создаем пользователя
         cls.user = User.objects.create_user(username='HasNoName')
 
+    def setUp(self):
+        cache.clear()
+
     def test_urls_uses_correct_template(self):
         """add_coment использует соответствующий шаблон."""
 
         response = self.guest_client.get('/unexisting_page/')
         self.assertTemplateUsed(response, 'core/404.html')
+
+    def test_anonymous_404_from_cache(self):
+        """Анонимам 404 отдаётся готовой страницей со своим адресом."""
+        self.guest_client.get('/unexisting_page/')
+        response = self.guest_client.get('/other/<b>/')
+        self.assertEqual(response.status_code, 404)
+        self.assertTemplateNotUsed(response, 'core/404.html')
+        self.assertContains(response, '/other/&lt;b&gt;/', status_code=404)
+        self.assertNotContains(response, 'unexisting_page', status_code=404)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_misses_rebuild_once(self):
+        """Одновременные промахи по ключу перестраивают значение один раз."""
+        store = {}
+        rebuilds = []
+
+        def rebuild():
+            rebuilds.append(1)
+            time.sleep(0.1)
+            store['value'] = 'page'
+            return 'page'
+
+        results = []
+
+        def request():
+            results.append(singleflight.coalesce(
+                'test-key', lookup=lambda: store.get('value'),
+                rebuild=rebuild,
+            ))
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['page'] * 8)
+        self.assertEqual(len(rebuilds), 1)
+        stats = singleflight.stats()
+        self.assertEqual(stats['rebuilds'], 1)
+        self.assertEqual(stats['coalesced'], stats['waiters'])
+        self.assertGreater(stats['coalesced'], 0)
+
+    def test_waiter_rebuilds_after_timeout(self):
+        """Не дождавшись перестроения, запрос строит значение сам."""
+        lock = singleflight.KeyLock('slow-key')
+        self.assertTrue(lock.acquire(timeout=0))
+        try:
+            value = singleflight.coalesce(
+                'slow-key', lookup=lambda: None,
+                rebuild=lambda: 'own', wait=0.05,
+            )
+        finally:
+            lock.release()
+        self.assertEqual(value, 'own')
+        self.assertEqual(singleflight.stats()['timeouts'], 1)
+
+
+def _set_in_child(location, key, value):
+    TwoTierCache(location, {}).set(key, value)
+
+
+class TwoTierCacheTests(SimpleTestCase):
+    """L1 воркера сбрасывается, когда L2 меняет другой воркер."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.location = os.path.join(self.directory, 'cache.sqlite3')
+
+    def worker(self, **options):
+        # Экземпляры бэкенда со своими L1 ведут себя как разные воркеры.
+        return TwoTierCache(self.location, {'OPTIONS': options})
+
+    def test_cache_api(self):
+        """Бэкенд поддерживает операции, на которые опирается проект."""
+        cache_ = self.worker()
+        cache_.set('a', [1, 2])
+        self.assertEqual(cache_.get('a'), [1, 2])
+        self.assertTrue(cache_.add('b', 1))
+        self.assertFalse(cache_.add('b', 2))
+        self.assertEqual(cache_.incr('b', 5), 6)
+        with self.assertRaises(ValueError):
+            cache_.incr('missing')
+        self.assertEqual(cache_.get_or_set('c', 'built'), 'built')
+        self.assertEqual(
+            cache_.get_many(['a', 'b', 'missing']), {'a': [1, 2], 'b': 6}
+        )
+        cache_.delete_many(['a', 'b'])
+        self.assertIsNone(cache_.get('a'))
+        cache_.set('short', 1, timeout=0)
+        self.assertIsNone(cache_.get('short'))
+        cache_.clear()
+        self.assertIsNone(cache_.get('c'))
+
+    def test_values_are_copies(self):
+        """Изменение прочитанного значения не портит L1."""
+        cache_ = self.worker()
+        cache_.set('list', [1])
+        cache_.get('list').append(2)
+        self.assertEqual(cache_.get('list'), [1])
+
+    def test_write_in_other_worker_invalidates_l1(self):
+        """Запись, удаление и clear в одном воркере видны в другом."""
+        first, second = self.worker(), self.worker()
+        first.set('key', 'old')
+        self.assertEqual(second.get('key'), 'old')
+        first.set('key', 'new')
+        self.assertEqual(second.get('key'), 'new')
+        first.add('counter', 1)
+        self.assertEqual(second.get('counter'), 1)
+        first.incr('counter')
+        self.assertEqual(second.get('counter'), 2)
+        first.delete('key')
+        self.assertIsNone(second.get('key'))
+        second.set('key', 'again')
+        self.assertEqual(second.get('key'), 'again')
+        first.clear()
+        self.assertIsNone(second.get('key'))
+
+    def test_pruned_log_clears_l1(self):
+        """Если журнал уже обрезан, воркер сбрасывает весь L1."""
+        first = self.worker(INVALIDATION_LOG_SIZE=1)
+        second = self.worker()
+        first.set_many({'a': 1, 'b': 1})
+        self.assertEqual(second.get_many(['a', 'b']), {'a': 1, 'b': 1})
+        first.set('a', 2)
+        first.set('b', 2)
+        first.set('c', 2)
+        self.assertEqual(second.get_many(['a', 'b']), {'a': 2, 'b': 2})
+
+    def test_l1_is_bounded(self):
+        """L1 хранит не больше L1_MAX_ENTRIES записей."""
+        cache_ = self.worker(L1_MAX_ENTRIES=2)
+        cache_.set_many({'a': 1, 'b': 2, 'c': 3})
+        cache_.get_many(['a', 'b', 'c'])
+        self.assertEqual(list(cache_._l1), [
+            cache_.make_key('b'), cache_.make_key('c'),
+        ])
+
+    def test_other_process_sees_writes(self):
+        """Значение, записанное другим процессом, читается из L2."""
+        cache_ = self.worker()
+        cache_.set('shared', 'parent')
+        self.assertEqual(cache_.get('shared'), 'parent')
+        context = multiprocessing.get_context('fork')
+        child = context.Process(
+            target=_set_in_child, args=(self.location, 'shared', 'child')
+        )
+        child.start()
+        child.join()
+        self.assertEqual(child.exitcode, 0)
+        self.assertEqual(cache_.get('shared'), 'child')
+
+    def test_tests_use_own_cache(self):
+        """Тесты не пишут в каталог кэша сервера."""
+        location = settings.CACHES['default']['LOCATION']
+        self.assertNotEqual(
+            settings.CACHE_DIR, os.path.join(settings.BASE_DIR, 'cache')
+        )
+        self.assertTrue(location.startswith(settings.CACHE_DIR))
+
+    def test_location_required(self):
+        """Без LOCATION бэкенд не создаётся."""
+        with self.assertRaises(ImproperlyConfigured):
+            TwoTierCache('', {})
+
+    def test_directory_is_private(self):
+        """Каталог кэша создаётся закрытым, чужие права снимаются."""
+        directory = os.path.join(self.directory, 'nested')
+        TwoTierCache(os.path.join(directory, 'cache.sqlite3'), {}).set(1, 1)
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+        os.chmod(directory, 0o777)
+        private_dir(directory)
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+
+    def test_foreign_directory_refused(self):
+        """Каталог другого пользователя не принимается."""
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            with self.assertRaises(ImproperlyConfigured):
+                self.worker().get('key')
+            with override_settings(SINGLEFLIGHT_LOCK_DIR=self.directory):
+                with self.assertRaises(ImproperlyConfigured):
+                    singleflight._lock_dir()
+
+
+@query_budget(queries=1, duplicates=0)
+def _budget_view(request):
+    User.objects.filter(pk__in=[1]).count()
+    User.objects.filter(pk__in=[1, 2]).count()
+    return HttpResponse()
+
+
+class QueryBudgetTests(TestCase):
+    """Middleware считает запросы и сверяет их с бюджетом представления."""
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self):
+        def get_response(request):
+            middleware.process_view(request, _budget_view, (), {})
+            return _budget_view(request)
+
+        middleware = QueryBudgetMiddleware(get_response)
+        return middleware(RequestFactory().get('/budget/'))
+
+    def test_headers(self):
+        """Число запросов, время и повторы попадают в заголовки."""
+        response = self.client.get(reverse('posts:index'))
+        self.assertIn('X-DB-Queries', response)
+        self.assertIn('X-DB-Time', response)
+        self.assertEqual(response['X-DB-Duplicates'], '0')
+        self.assertEqual(response['X-Query-Budget'], 'ok')
+
+    @override_settings(QUERY_BUDGET_STRICT=False)
+    def test_exceeded_budget_is_tagged(self):
+        """Запросы одного вида считаются повтором, превышение помечается."""
+        with self.assertLogs('core.query_budget', 'WARNING'):
+            response = self.get()
+        self.assertEqual(response['X-DB-Queries'], '2')
+        self.assertEqual(response['X-DB-Duplicates'], '1')
+        self.assertEqual(response['X-Query-Budget'], 'exceeded')
+
+    @override_settings(QUERY_BUDGET_STRICT=True)
+    def test_strict_mode_raises(self):
+        """В строгом режиме превышение бюджета роняет тест."""
+        with self.assertRaises(QueryBudgetExceeded):
+            self.get()
@@ -1,8 +1,31 @@
+from django.core.cache import cache
+from django.http import HttpResponseNotFound
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.html import escape
+
+NOT_FOUND_KEY = 'core:not_found_page'
+NOT_FOUND_TIMEOUT = 60 * 60
+# На месте адреса в готовой странице; подставляется на каждый ответ.
+PATH_MARKER = '__not_found_path__'
 
 
 def page_not_found(request, exception):
-    return render(request, 'core/404.html', {'path': request.path}, status=404)
+    """404; анонимам — страница, отрендеренная заранее и взятая из кэша."""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return render(
+            request, 'core/404.html', {'path': request.path}, status=404
+        )
+    body = cache.get(NOT_FOUND_KEY)
+    if body is None:
+        body = render_to_string(
+            'core/404.html', {'path': PATH_MARKER}, request=request
+        )
+        cache.set(NOT_FOUND_KEY, body, NOT_FOUND_TIMEOUT)
+    return HttpResponseNotFound(
+        body.replace(PATH_MARKER, escape(request.path))
+    )
 
 
 def server_error(request):
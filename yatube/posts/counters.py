@@ -0,0 +1,89 @@
+"""Денормализованные счётчики постов, комментариев и подписок.
+
+Счётчики меняются сигналами в той же транзакции, что и сама запись;
+команда `recount` пересчитывает их, если они всё же разошлись.
+"""
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Comment, Follow, Post, User, UserCounter
+
+
+def _count_subquery(queryset, field):
+    return Coalesce(
+        Subquery(
+            queryset.filter(**{field: OuterRef('pk')})
+            .order_by()
+            .values(field)
+            .annotate(total=Count('pk'))
+            .values('total')
+        ),
+        0,
+    )
+
+
+def recount_users(users=None):
+    """Пересчитывает счётчики пользователей (по умолчанию — всех)."""
+    users = User.objects.all() if users is None else users
+    rows = users.annotate(
+        posts_total=_count_subquery(Post.objects.all(), 'author'),
+        followers_total=_count_subquery(Follow.objects.all(), 'author'),
+        following_total=_count_subquery(Follow.objects.all(), 'user'),
+    ).values_list('pk', 'posts_total', 'followers_total', 'following_total')
+    for user_id, posts, followers, following in rows:
+        UserCounter.objects.update_or_create(
+            user_id=user_id,
+            defaults={
+                'posts': posts,
+                'followers': followers,
+                'following': following,
+            },
+        )
+
+
+def recount_posts(posts=None):
+    """Пересчитывает число комментариев постов (по умолчанию — всех)."""
+    posts = Post.objects.all() if posts is None else posts
+    posts.update(
+        comments_count=_count_subquery(Comment.objects.all(), 'post')
+    )
+
+
+def change_user(user_id, **deltas):
+    """Сдвигает счётчики пользователя, например `posts=1`.
+
+    Строку не создаёт: она заводится вместе с пользователем, а если
+    её нет, `for_user` посчитает всё с нуля при первом чтении. Так
+    каскадное удаление пользователя, которое уже убрало его строку,
+    не вернёт её обратно.
+    """
+    if user_id is None:
+        return
+    UserCounter.objects.filter(user_id=user_id).update(
+        **{
+            name: Greatest(F(name) + delta, 0)
+            for name, delta in deltas.items()
+        }
+    )
+
+
+def create_for_user(user_id):
+    """Заводит нулевые счётчики только что созданного пользователя."""
+    UserCounter.objects.get_or_create(user_id=user_id)
+
+
+def change_post(post_id, delta):
+    if post_id is None:
+        return
+    Post.objects.filter(pk=post_id).update(
+        comments_count=Greatest(F('comments_count') + delta, 0)
+    )
+
+
+def for_user(user):
+    """Счётчики пользователя; строка создаётся при первом обращении."""
+    try:
+        return user.counters
+    except UserCounter.DoesNotExist:
+        recount_users(User.objects.filter(pk=user.pk))
+        return UserCounter.objects.get(user=user)
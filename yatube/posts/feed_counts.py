@@ -0,0 +1,82 @@
+from django.core.cache import cache
+from django.db import transaction
+
+# Счётчики поддерживаются сигналами, срок жизни лишь страхует от дрейфа.
+FEED_COUNT_TIMEOUT = 60 * 60 * 24
+
+
+def index_scope():
+    return 'index'
+
+
+def group_scope(group_id):
+    return f'group:{group_id}'
+
+
+def author_scope(author_id):
+    return f'author:{author_id}'
+
+
+def post_scopes(group_id, author_id):
+    """Все ленты, в которые попадает пост."""
+    scopes = [index_scope(), author_scope(author_id)]
+    if group_id is not None:
+        scopes.append(group_scope(group_id))
+    return scopes
+
+
+def _key(scope):
+    return f'feed_count:{scope}'
+
+
+class _Change:
+    """Сдвиг счётчика, который применится после фиксации транзакции."""
+
+    def __init__(self, scope, delta):
+        self.scope = scope
+        self.delta = delta
+
+    def __call__(self):
+        try:
+            cache.incr(_key(self.scope), self.delta)
+        except ValueError:
+            # Счётчик ещё не посчитан — его посчитает первый читатель.
+            pass
+
+
+def _pending_delta(scope):
+    """Сдвиги ленты, сделанные текущей транзакцией и ещё не применённые.
+
+    Django сам убирает из списка on_commit то, что зарегистрировали
+    в откаченных точках сохранения.
+    """
+    connection = transaction.get_connection()
+    return sum(
+        func.delta
+        for _, func in connection.run_on_commit
+        if isinstance(func, _Change) and func.scope == scope
+    )
+
+
+def get_count(scope, queryset):
+    """Число постов ленты из кэша; COUNT(*) только при пустом кэше.
+
+    В кэше лежит число по зафиксированным данным, а транзакция видит
+    его вместе со своими ещё не применёнными сдвигами.
+    """
+    pending = _pending_delta(scope)
+    count = cache.get(_key(scope))
+    if count is None:
+        count = queryset.count()
+        cache.add(_key(scope), count - pending, FEED_COUNT_TIMEOUT)
+        return count
+    return count + pending
+
+
+def change_count(scope, delta):
+    """Сдвигает счётчик ленты после фиксации текущей транзакции.
+
+    При откате счётчик не меняется, а другие процессы не видят сдвига
+    раньше, чем сам пост.
+    """
+    transaction.on_commit(_Change(scope, delta))
@@ -0,0 +1,118 @@
+"""Граф подписок в кэше: отсортированные массивы id.
+
+Для каждого пользователя хранятся id авторов, на которых он подписан,
+и id его подписчиков — `array('q')` по возрастанию. Проверка подписки —
+двоичный поиск по массиву, без запроса к БД.
+
+Сигналы Follow сразу сбрасывают затронутые массивы (так откат
+транзакции не оставит в кэше лишнего ребра), а после фиксации
+дописывают изменение в массивы, которые успели собрать заново.
+Сборка и правка массива идут под `core.singleflight.KeyLock`.
+"""
+from array import array
+from bisect import bisect_left, insort
+
+from django.core.cache import cache
+from django.db import transaction
+
+from core import singleflight
+
+from .models import Follow
+
+FOLLOWEES = 'followees'
+FOLLOWERS = 'followers'
+GRAPH_TIMEOUT = 60 * 60 * 24
+
+
+def _key(kind, user_id):
+    return f'follow_graph:{kind}:{user_id}'
+
+
+def _load(kind, user_id):
+    if kind == FOLLOWEES:
+        ids = Follow.objects.filter(user_id=user_id).values_list(
+            'author_id', flat=True
+        )
+    else:
+        ids = Follow.objects.filter(author_id=user_id).values_list(
+            'user_id', flat=True
+        )
+    return array('q', sorted(pk for pk in ids if pk is not None))
+
+
+def _ids(kind, user_id):
+    key = _key(kind, user_id)
+    ids = cache.get(key)
+    if ids is not None:
+        return ids
+    lock = singleflight.KeyLock(key)
+    if not lock.acquire(timeout=singleflight.WAIT_TIMEOUT):
+        return _load(kind, user_id)
+    try:
+        ids = cache.get(key)
+        if ids is None:
+            ids = _load(kind, user_id)
+            cache.set(key, ids, GRAPH_TIMEOUT)
+        return ids
+    finally:
+        lock.release()
+
+
+def followee_ids(user_id):
+    """Отсортированные id авторов, на которых подписан пользователь."""
+    return _ids(FOLLOWEES, user_id)
+
+
+def follower_ids(user_id):
+    """Отсортированные id подписчиков пользователя."""
+    return _ids(FOLLOWERS, user_id)
+
+
+def _contains(ids, value):
+    position = bisect_left(ids, value)
+    return position < len(ids) and ids[position] == value
+
+
+def is_following(user_id, author_id):
+    if user_id is None or author_id is None:
+        return False
+    return _contains(followee_ids(user_id), author_id)
+
+
+def _patch(kind, user_id, other_id, added):
+    key = _key(kind, user_id)
+    lock = singleflight.KeyLock(key)
+    if not lock.acquire(timeout=singleflight.WAIT_TIMEOUT):
+        cache.delete(key)
+        return
+    try:
+        ids = cache.get(key)
+        if ids is None:
+            return
+        present = _contains(ids, other_id)
+        if added and not present:
+            insort(ids, other_id)
+        elif not added and present:
+            del ids[bisect_left(ids, other_id)]
+        else:
+            return
+        cache.set(key, ids, GRAPH_TIMEOUT)
+    finally:
+        lock.release()
+
+
+def edge_changed(user_id, author_id, added):
+    """Отражает в графе подписку (`added`) или отписку."""
+    if user_id is None or author_id is None:
+        return
+    edges = [
+        (FOLLOWEES, user_id, author_id),
+        (FOLLOWERS, author_id, user_id),
+    ]
+    cache.delete_many([_key(kind, owner) for kind, owner, _ in edges])
+
+    def patch():
+        for kind, owner, other in edges:
+            _patch(kind, owner, other, added)
+
+    transaction.on_commit(patch)
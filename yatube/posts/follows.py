@@ -0,0 +1,63 @@
+"""Идемпотентные подписки и отписки, в том числе пачками.
+
+Повторная подписка ничего не меняет: пара (user, author) уникальна.
+Массовые операции идут пачками по `BATCH_SIZE` авторов, каждая пачка —
+отдельная транзакция. Строки создаются и удаляются по одной, чтобы
+сработали сигналы лент, счётчиков и кэша страниц.
+"""
+from django.db import transaction
+
+from .models import Follow
+
+BATCH_SIZE = 500
+
+
+def follow(user, author):
+    """Подписывает на автора; возвращает True, если подписка новая."""
+    if user.pk == author.pk:
+        return False
+    _, created = Follow.objects.get_or_create(user=user, author=author)
+    return created
+
+
+def unfollow(user, author):
+    """Отписывает от автора; возвращает True, если подписка была."""
+    deleted, _ = Follow.objects.filter(user=user, author=author).delete()
+    return bool(deleted)
+
+
+def _batches(author_ids, batch_size):
+    author_ids = sorted(set(author_ids))
+    for start in range(0, len(author_ids), batch_size):
+        yield author_ids[start:start + batch_size]
+
+
+def follow_many(user, author_ids, batch_size=BATCH_SIZE):
+    """Подписывает на авторов пачками; возвращает число новых подписок."""
+    created = 0
+    for batch in _batches(set(author_ids) - {user.pk}, batch_size):
+        with transaction.atomic():
+            existing = set(
+                Follow.objects.filter(user=user, author_id__in=batch)
+                .values_list('author_id', flat=True)
+            )
+            for author_id in batch:
+                if author_id in existing:
+                    continue
+                _, is_new = Follow.objects.get_or_create(
+                    user=user, author_id=author_id
+                )
+                created += is_new
+    return created
+
+
+def unfollow_many(user, author_ids, batch_size=BATCH_SIZE):
+    """Отписывает от авторов пачками; возвращает число снятых подписок."""
+    deleted = 0
+    for batch in _batches(author_ids, batch_size):
+        with transaction.atomic():
+            count, _ = Follow.objects.filter(
+                user=user, author_id__in=batch
+            ).delete()
+            deleted += count
+    return deleted
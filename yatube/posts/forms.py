@@ -1,13 +1,43 @@
 from django.forms import ModelForm
+from django.forms.models import ModelChoiceIterator
 
+from . import group_registry, images
 from .models import Comment, Post
 
 
+class GroupChoiceIterator(ModelChoiceIterator):
+    """Варианты группы из реестра групп, без запроса к базе."""
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for group in group_registry.all_groups():
+            yield self.choice(group)
+
+    def __len__(self):
+        empty = self.field.empty_label is not None
+        return len(group_registry.all_groups()) + empty
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(
+            group_registry.all_groups()
+        )
+
+
 class PostForm(ModelForm):
     class Meta:
         model = Post
         fields = ('text', 'group', 'image',)
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        group = self.fields['group']
+        group.iterator = GroupChoiceIterator
+        group.widget.choices = group.choices
+
+    def clean_image(self):
+        return images.normalize_upload(self.cleaned_data.get('image'))
+
 
 class CommentForm(ModelForm):
     class Meta:
@@ -0,0 +1,69 @@
+"""Реестр групп в памяти процесса.
+
+Групп немного, и меняются они редко, поэтому процесс держит их все:
+варианты группы в форме поста, поиск группы по slug и `post.group`
+в лентах обходятся без запросов. Реестр помечен версией таблицы групп
+из `query_cache`: её сдвигают сохранение и удаление группы, а также
+массовые изменения. Процесс сверяет версию при каждом обращении
+и при расхождении перечитывает группы.
+"""
+import threading
+
+from django.http import Http404
+
+from . import query_cache
+from .models import Group
+
+
+class _Snapshot:
+    def __init__(self, version, groups):
+        self.version = version
+        self.groups = groups
+        self.by_id = {group.pk: group for group in groups}
+        self.by_slug = {group.slug: group for group in groups}
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def _current():
+    global _snapshot
+    version = query_cache.table_version(Group._meta.db_table)
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = _Snapshot(version, list(Group.objects.order_by('pk')))
+        return _snapshot
+
+
+def all_groups():
+    """Все группы по возрастанию id."""
+    return _current().groups
+
+
+def get(pk):
+    return _current().by_id.get(pk)
+
+
+def by_slug(slug):
+    return _current().by_slug.get(slug)
+
+
+def get_or_404(slug):
+    group = by_slug(slug)
+    if group is None:
+        raise Http404('No Group matches the given query.')
+    return group
+
+
+def attach(posts):
+    """Подставляет постам группы из реестра вместо JOIN или запроса."""
+    by_id = _current().by_id
+    for post in posts:
+        group = by_id.get(post.group_id)
+        if group is not None:
+            post.group = group
+    return posts
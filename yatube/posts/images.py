@@ -0,0 +1,185 @@
+"""Нормализация картинок постов при загрузке.
+
+Размер картинки читается из заголовка, без декодирования пикселей.
+Картинки больше `IMAGE_MAX_PIXELS` отклоняются, остальные уменьшаются
+до `IMAGE_MAX_SIDE` по большей стороне и пересохраняются без
+метаданных (EXIF, XMP, комментарии) в режиме, который формат умеет
+сохранять и браузер — показывать: CMYK и 16-битные картинки переводятся
+в 8 бит на канал. Снимки камер в MPO (JPEG с превью) сохраняются как
+JPEG из первого кадра. В анимированных GIF, WebP и PNG так же
+уменьшается каждый кадр, а длительности кадров и число повторов
+сохраняются. Картинку, которую Pillow не смог разобрать,
+форма отклоняет как ошибку ввода. Обработка идёт в ограниченном
+пуле: одновременно декодируется не больше `IMAGE_WORKERS` картинок,
+а ждать места может не больше `IMAGE_QUEUE_SIZE` загрузок.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from io import BytesIO
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import UploadedFile
+from PIL import Image, ImageOps, ImageSequence
+
+MAX_PIXELS = getattr(settings, 'IMAGE_MAX_PIXELS', 40_000_000)
+MAX_SIDE = getattr(settings, 'IMAGE_MAX_SIDE', 2560)
+WORKERS = getattr(settings, 'IMAGE_WORKERS', 2)
+QUEUE_SIZE = getattr(settings, 'IMAGE_QUEUE_SIZE', 8)
+WAIT_TIMEOUT = getattr(settings, 'IMAGE_WAIT_TIMEOUT', 30)
+
+JPEG_QUALITY = 90
+SAVE_FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp'}
+FALLBACK_FORMAT = 'PNG'
+# Режимы, которые формат сохраняет и браузеры показывают.
+SAVE_MODES = {
+    'JPEG': ('L', 'RGB'),
+    'PNG': ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'),
+    'GIF': ('1', 'L', 'P'),
+    'WEBP': ('RGB', 'RGBA'),
+}
+# Форматы, которые сохраняют анимацию; у прочих берётся первый кадр.
+ANIMATED_FORMATS = ('GIF', 'PNG', 'WEBP')
+# Больше 8 бит на канал: 16-битные и 32-битные целые, вещественные.
+HIGH_DEPTH_MODES = ('I', 'F')
+
+_executor = ThreadPoolExecutor(
+    max_workers=WORKERS, thread_name_prefix='images'
+)
+_slots = threading.BoundedSemaphore(WORKERS + QUEUE_SIZE)
+
+
+def _check_budget(width, height, frames=1):
+    if width * height * frames > MAX_PIXELS:
+        raise ValidationError(
+            'Картинка слишком большая: не больше %(limit)s Мп.',
+            code='too_many_pixels',
+            params={'limit': MAX_PIXELS // 1_000_000},
+        )
+
+
+def _save_params(image, image_format):
+    params = {}
+    if image_format == 'JPEG':
+        params.update(quality=JPEG_QUALITY, optimize=True)
+    elif 'transparency' in image.info:
+        params['transparency'] = image.info['transparency']
+    # Цветовой профиль — не метаданные: без него поедут цвета.
+    if image.info.get('icc_profile'):
+        params['icc_profile'] = image.info['icc_profile']
+    return params
+
+
+def _to_8bit(image):
+    """Растягивает диапазон яркости многобитной картинки на 0–255."""
+    image = image.convert('F')
+    low, high = image.getextrema()
+    scale = 255 / (high - low) if high > low else 0
+    return image.point(lambda value: (value - low) * scale).convert('L')
+
+
+def _convert(image, image_format):
+    """Переводит картинку в режим, который `image_format` сохраняет."""
+    modes = SAVE_MODES[image_format]
+    if image.mode in modes:
+        return image
+    if image.mode.startswith(HIGH_DEPTH_MODES):
+        image = _to_8bit(image)
+        if image.mode in modes:
+            return image
+    has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+    return image.convert('RGBA' if has_alpha and 'RGBA' in modes else 'RGB')
+
+
+def _animation(source, image_format):
+    """Пересобирает анимацию из уменьшенных кадров без метаданных."""
+    params = {'save_all': True, 'loop': source.info.get('loop', 0)}
+    if source.info.get('icc_profile'):
+        params['icc_profile'] = source.info['icc_profile']
+    if image_format == 'GIF':
+        # Кадры полные: каждый заменяет предыдущий целиком.
+        params['disposal'] = 2
+    frames, durations = [], []
+    for frame in ImageSequence.Iterator(source):
+        # WebP узнаёт длительность кадра, только декодировав его.
+        frame.load()
+        durations.append(frame.info.get('duration', 0))
+        frame = frame.convert('RGBA')
+        frame.info = {}
+        frame.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+        frames.append(frame)
+    output = BytesIO()
+    frames[0].save(
+        output, format=image_format, append_images=frames[1:],
+        duration=durations, **params
+    )
+    return output.getvalue()
+
+
+def _normalize(upload):
+    upload.seek(0)
+    with Image.open(upload) as source:
+        image_format = source.format
+        frames = getattr(source, 'n_frames', 1)
+        if image_format == 'MPO':
+            # Снимок камеры: первый кадр — сама фотография.
+            image_format, frames = 'JPEG', 1
+        _check_budget(*source.size, frames)
+        if (
+            getattr(source, 'is_animated', False)
+            and image_format in ANIMATED_FORMATS
+        ):
+            return ContentFile(
+                _animation(source, image_format), name=upload.name
+            )
+        # JPEG сразу декодируется в уменьшенном масштабе.
+        source.draft(source.mode, (MAX_SIDE, MAX_SIDE))
+        image = ImageOps.exif_transpose(source)
+
+    name = upload.name
+    if image_format not in SAVE_FORMATS:
+        image_format = FALLBACK_FORMAT
+        name = os.path.splitext(name)[0] + SAVE_FORMATS[image_format]
+    image = _convert(image, image_format)
+    image.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+    params = _save_params(image, image_format)
+    image.info = {}
+    output = BytesIO()
+    image.save(output, format=image_format, **params)
+    return ContentFile(output.getvalue(), name=name)
+
+
+def normalize(upload):
+    """Уменьшает картинку и убирает метаданные; возвращает новый файл."""
+    try:
+        return _normalize(upload)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        raise ValidationError(
+            'Не удалось обработать картинку.', code='invalid_image'
+        ) from error
+
+
+def normalize_upload(upload):
+    """Нормализует загруженную картинку в пуле; прочее отдаёт как есть.
+
+    Если пул и очередь заняты дольше `IMAGE_WAIT_TIMEOUT` секунд,
+    загрузка отклоняется, а не копится в памяти.
+    """
+    if not isinstance(upload, UploadedFile):
+        return upload
+    if not _slots.acquire(timeout=WAIT_TIMEOUT):
+        raise ValidationError(
+            'Сервер занят обработкой картинок, попробуйте позже.',
+            code='busy',
+        )
+    future = _executor.submit(normalize, upload)
+    future.add_done_callback(lambda future: _slots.release())
+    try:
+        return future.result(timeout=WAIT_TIMEOUT)
+    except FutureTimeout:
+        raise ValidationError(
+            'Картинка обрабатывается слишком долго.', code='timeout'
+        )
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import follows
+from posts.models import User
+
+
+class Command(BaseCommand):
+    help = 'Подписывает пользователя на авторов (или отписывает) пачками.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='Кто подписывается.')
+        parser.add_argument('authors', nargs='+', help='На кого.')
+        parser.add_argument(
+            '--unfollow', action='store_true', help='Отписать от авторов.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=follows.BATCH_SIZE,
+        )
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f'Нет пользователя {options["username"]}')
+        author_ids = User.objects.filter(
+            username__in=options['authors']
+        ).values_list('pk', flat=True)
+        if options['unfollow']:
+            changed = follows.unfollow_many(
+                user, author_ids, options['batch_size']
+            )
+            self.stdout.write(f'Снято подписок: {changed}')
+        else:
+            changed = follows.follow_many(
+                user, author_ids, options['batch_size']
+            )
+            self.stdout.write(f'Новых подписок: {changed}')
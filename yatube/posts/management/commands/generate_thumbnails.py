@@ -0,0 +1,60 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from posts import thumbnails
+from posts.models import Post
+
+
+def _init_worker():
+    # В spawn-процессах Django ещё не настроен; при fork вызов безвреден.
+    django.setup()
+
+
+def _generate(name):
+    try:
+        thumbnails.generate(name)
+    except Exception as error:
+        return name, str(error)
+    return name, None
+
+
+class Command(BaseCommand):
+    help = 'Строит миниатюры для всех картинок постов на всех ядрах.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+        )
+
+    def handle(self, *args, **options):
+        names = list(
+            Post.objects.exclude(image='')
+            .order_by()
+            .values_list('image', flat=True)
+            .distinct()
+        )
+        workers = max(1, options['workers'])
+        if workers == 1:
+            failed = self.report(map(_generate, names))
+        else:
+            # Соединения с базой не должны переезжать в дочерние процессы.
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker
+            ) as pool:
+                failed = self.report(pool.map(_generate, names, chunksize=16))
+        self.stdout.write(
+            f'Миниатюры построены: {len(names) - failed}, ошибок: {failed}'
+        )
+
+    def report(self, results):
+        failed = 0
+        for name, error in results:
+            if error:
+                failed += 1
+                self.stderr.write(f'{name}: {error}')
+        return failed
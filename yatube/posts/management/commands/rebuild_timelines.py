@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from posts import timelines
+from posts.models import Follow
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает материализованные ленты подписок пачками.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'usernames', nargs='*',
+            help='Пользователи; по умолчанию все, у кого есть подписки.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=timelines.BATCH_SIZE,
+        )
+
+    def handle(self, *args, **options):
+        follows = Follow.objects.all()
+        if options['usernames']:
+            follows = follows.filter(user__username__in=options['usernames'])
+        user_ids = (
+            follows.order_by('user_id')
+            .values_list('user_id', flat=True)
+            .distinct()
+        )
+        done = 0
+        for rebuilt in timelines.rebuild(user_ids, options['batch_size']):
+            done += rebuilt
+            self.stdout.write(f'Пересобрано лент: {done}')
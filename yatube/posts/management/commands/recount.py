@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from posts import counters
+from posts.models import Post, User
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает денормализованные счётчики постов и подписок.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def batches(self, queryset, batch_size):
+        ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(ids), batch_size):
+            yield queryset.filter(pk__in=ids[start:start + batch_size])
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for users in self.batches(User.objects.all(), batch_size):
+            with transaction.atomic():
+                counters.recount_users(users)
+        for posts in self.batches(Post.objects.all(), batch_size):
+            with transaction.atomic():
+                counters.recount_posts(posts)
+        self.stdout.write('Счётчики пересчитаны')
@@ -0,0 +1,55 @@
+# Generated by Django 2.2.16 on 2026-10-18 03:59
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_follows(apps, schema_editor):
+    """Оставляет по одной подписке на пару (user, author).
+
+    Счётчики подписчиков и подписок затронутых пользователей
+    пересчитываются: раньше они учитывали и дубликаты.
+    """
+    Follow = apps.get_model('posts', 'Follow')
+    UserCounter = apps.get_model('posts', 'UserCounter')
+    duplicates = (
+        Follow.objects.values('user_id', 'author_id')
+        .annotate(keep_id=Min('id'), total=Count('id'))
+        .filter(total__gt=1)
+    )
+    user_ids, author_ids = set(), set()
+    for pair in duplicates:
+        Follow.objects.filter(
+            user_id=pair['user_id'], author_id=pair['author_id']
+        ).exclude(id=pair['keep_id']).delete()
+        user_ids.add(pair['user_id'])
+        author_ids.add(pair['author_id'])
+    for user_id in user_ids - {None}:
+        UserCounter.objects.filter(user_id=user_id).update(
+            following=Follow.objects.filter(user_id=user_id).count()
+        )
+    for author_id in author_ids - {None}:
+        UserCounter.objects.filter(user_id=author_id).update(
+            followers=Follow.objects.filter(author_id=author_id).count()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0006_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_follows, migrations.RunPython.noop
+        ),
+        migrations.RemoveIndex(
+            model_name='follow',
+            name='follow_user_author_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='follow',
+            constraint=models.UniqueConstraint(fields=('user', 'author'), name='follow_user_author_unique'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.16 on 2026-10-18 03:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0007_follow_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usercounter',
+            index=models.Index(fields=['followers'], name='usercounter_followers_idx'),
+        ),
+    ]
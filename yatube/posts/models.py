@@ -1,6 +1,9 @@
 from django.contrib.auth import get_user_model
 from django.db import models
 
+from .query_cache import InvalidatingQuerySet
+from .storage import post_images
+
 User = get_user_model()
 
 
@@ -9,6 +12,8 @@ class Group(models.Model):
     slug = models.SlugField(unique=True)
     description = models.TextField(verbose_name='Описание')
 
+    objects = InvalidatingQuerySet.as_manager()
+
     def __str__(self):
         return self.title
 
@@ -17,6 +22,19 @@ class Group(models.Model):
         verbose_name_plural = "Группы"
 
 
+class PostQuerySet(InvalidatingQuerySet):
+    # Поля, которые читают шаблоны лент (article.html) и пагинатор.
+    # Группы подставляет реестр групп (posts.group_registry).
+    FEED_FIELDS = (
+        'text', 'pub_date', 'updated', 'image', 'author', 'group',
+        'author__username', 'author__first_name', 'author__last_name',
+    )
+
+    def for_feed(self):
+        """Посты для лент: автор тем же запросом, без лишних полей."""
+        return self.select_related('author').only(*self.FEED_FIELDS)
+
+
 class Post(models.Model):
     text = models.TextField(
         max_length=200,
@@ -26,13 +44,18 @@ class Post(models.Model):
     pub_date = models.DateTimeField(
         auto_now_add=True,
         verbose_name='Дата публикации',
-        db_index=True
+    )
+    updated = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Дата изменения',
     )
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
         related_name='posts',
-        verbose_name='Автор'
+        verbose_name='Автор',
+        # Поиск по автору обслуживает составной индекс ленты автора.
+        db_index=False,
     )
     group = models.ForeignKey(
         Group,
@@ -40,14 +63,23 @@ class Post(models.Model):
         null=True,
         on_delete=models.SET_NULL,
         related_name='posts',
+        db_index=False,
         verbose_name='Группа',
         help_text='Группа, к которой будет относиться пост'
     )
     image = models.ImageField(
         upload_to='posts/',
+        storage=post_images,
         blank=True,
         verbose_name='Картинка',
     )
+    comments_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Комментариев',
+    )
+
+    objects = PostQuerySet.as_manager()
 
     def __str__(self):
         _text_limit = 15
@@ -57,6 +89,22 @@ class Post(models.Model):
         verbose_name = 'Пост'
         verbose_name_plural = "Посты"
         ordering = ('-pub_date',)
+        # По индексу на каждую ленту: фильтр, затем порядок страниц.
+        indexes = [
+            models.Index(
+                fields=['-pub_date', '-id'], name='post_date_idx'
+            ),
+            models.Index(
+                fields=['group', '-pub_date', '-id'],
+                name='post_group_date_idx',
+            ),
+            models.Index(
+                fields=['author', '-pub_date', '-id'],
+                name='post_author_date_idx',
+            ),
+            # Есть ли ещё посты с файлом картинки (thumbnails.release).
+            models.Index(fields=['image'], name='post_image_idx'),
+        ]
 
 
 class Comment(models.Model):
@@ -67,6 +115,7 @@ class Comment(models.Model):
         on_delete=models.SET_NULL,
         related_name='comments',
         verbose_name='пост',
+        db_index=False,
     )
     author = models.ForeignKey(
         User,
@@ -86,6 +135,8 @@ class Comment(models.Model):
         verbose_name='Дата публикации'
     )
 
+    objects = InvalidatingQuerySet.as_manager()
+
     def __str__(self):
         _text_limit = 15
         return self.text[:_text_limit]
@@ -93,6 +144,12 @@ class Comment(models.Model):
     class Meta:
         verbose_name = 'Коммент'
         verbose_name_plural = "Комменты"
+        indexes = [
+            models.Index(
+                fields=['post', 'created', 'id'],
+                name='comment_post_created_idx',
+            ),
+        ]
 
 
 class Follow(models.Model):
@@ -102,6 +159,7 @@ class Follow(models.Model):
         null=True,
         on_delete=models.CASCADE,
         related_name='follower',
+        db_index=False,
     )
     author = models.ForeignKey(
         User,
@@ -110,3 +168,76 @@ class Follow(models.Model):
         on_delete=models.CASCADE,
         related_name='following',
     )
+
+    objects = InvalidatingQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'author'], name='follow_user_author_unique'
+            ),
+        ]
+
+
+class UserCounter(models.Model):
+    """Денормализованные счётчики пользователя."""
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='counters',
+    )
+    posts = models.PositiveIntegerField(default=0, verbose_name='Постов')
+    followers = models.PositiveIntegerField(
+        default=0, verbose_name='Подписчиков'
+    )
+    following = models.PositiveIntegerField(
+        default=0, verbose_name='Подписок'
+    )
+
+    objects = InvalidatingQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Счётчики пользователя'
+        verbose_name_plural = 'Счётчики пользователей'
+        # Авторы с подписчиками сверх TIMELINE_FANOUT_LIMIT (pull-режим).
+        indexes = [
+            models.Index(
+                fields=['followers'], name='usercounter_followers_idx'
+            ),
+        ]
+
+
+class TimelineEntry(models.Model):
+    """Пост в материализованной ленте подписок пользователя."""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='timeline',
+    )
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='timeline_entries',
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    pub_date = models.DateTimeField()
+
+    objects = InvalidatingQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('user', 'post')
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date', '-post'],
+                name='timeline_user_date_idx',
+            ),
+            models.Index(
+                fields=['user', 'author'],
+                name='timeline_user_author_idx',
+            ),
+        ]
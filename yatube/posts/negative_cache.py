@@ -0,0 +1,64 @@
+"""Кэш отсутствующих профилей и постов.
+
+Краулеры перебирают несуществующие имена и id. Промах поиска
+запоминается на `NEGATIVE_CACHE_TIMEOUT` секунд, и повторные запросы
+получают 404 без обращения к базе. Создание объекта пишет в тот же
+ключ отметку «существует»: промах, прочитанный из базы до создания,
+уже не перезапишет её (`cache.add`).
+
+Проверку делает декоратор `guard` снаружи кэша страниц: известный
+промах не доходит ни до кэша страниц, ни до базы и ничего в кэш
+не пишет.
+
+Группы сюда не входят: все их slug и так знает реестр групп.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+
+PROFILE = 'profile'
+POST = 'post'
+MISSING = 'missing'
+EXISTS = 'exists'
+TIMEOUT = getattr(settings, 'NEGATIVE_CACHE_TIMEOUT', 60 * 10)
+
+
+def _key(kind, value):
+    digest = hashlib.md5(str(value).encode()).hexdigest()
+    return f'negative:{kind}:{digest}'
+
+
+def _missing(kind, value):
+    return Http404(f'No {kind} matches the given query.')
+
+
+def guard(kind, argument):
+    """Декоратор view: известный промах по `kwargs[argument]` — 404 сразу.
+
+    Ставится над декораторами кэша страниц.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if cache.get(_key(kind, kwargs[argument])) == MISSING:
+                raise _missing(kind, kwargs[argument])
+            return view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def remember_missing(kind, value, lookup):
+    """Возвращает `lookup()`; его 404 запоминается для `guard`."""
+    try:
+        return lookup()
+    except Http404:
+        cache.add(_key(kind, value), MISSING, TIMEOUT)
+        raise
+
+
+def exists(kind, value):
+    """Отмечает, что объект есть: запомненный промах больше не действует."""
+    cache.set(_key(kind, value), EXISTS, TIMEOUT)
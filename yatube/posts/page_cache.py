@@ -0,0 +1,355 @@
+"""Кэш страниц с версиями областей и персональными «дырками».
+
+В кэш попадает страница, отрендеренная без персональных частей:
+на их месте тег `{% personal %}` оставляет метку. На каждый ответ
+метки заполняются для текущего посетителя, так что одна запись
+обслуживает всех. Для анонимов страница заполняется один раз при
+рендере и отдаётся из кэша целиком.
+"""
+import base64
+import copy
+import hashlib
+import json
+import re
+import threading
+import time
+from functools import wraps
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connections
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import patch_vary_headers
+from django.utils.safestring import mark_safe
+
+from core import singleflight
+
+from . import pending
+
+
+def _version_key(scope):
+    return f'page_version:{scope}'
+
+
+def _new_version():
+    # Версия от времени: если ключ версии вытеснят из кэша,
+    # старые страницы не оживут под той же версией.
+    return time.time_ns()
+
+
+def _bump(scopes):
+    for scope in scopes:
+        try:
+            cache.incr(_version_key(scope))
+        except ValueError:
+            cache.set(_version_key(scope), _new_version(), None)
+
+
+_pending = pending.PendingChanges(_bump)
+
+
+def get_version(scope):
+    _pending.before_read([scope])
+    return cache.get_or_set(_version_key(scope), _new_version, None)
+
+
+def bump_version(*scopes, using=None):
+    """Делает недействительными все закэшированные страницы областей.
+
+    Внутри транзакции версии сдвигаются после её фиксации: иначе
+    страница, отрендеренная по прежним строкам, закэшировалась бы
+    под новой версией.
+    """
+    _pending.changed(scopes, using=using)
+
+
+def index_scope():
+    return 'index'
+
+
+def group_scope(slug):
+    return f'group:{slug}'
+
+
+def profile_scope(username):
+    return f'profile:{username}'
+
+
+def post_scope(post_id):
+    return f'post:{post_id}'
+
+
+def article_author_scope(author_id):
+    return f'article-author:{author_id}'
+
+
+def article_group_scope(group_id):
+    return f'article-group:{group_id}'
+
+
+def article_scopes(posts):
+    """Области авторов и групп постов: их имена и названия на странице."""
+    scopes = set()
+    for post in posts:
+        scopes.add(article_author_scope(post.author_id))
+        if post.group_id is not None:
+            scopes.add(article_group_scope(post.group_id))
+    return scopes
+
+
+HOLE_PATTERN = re.compile(r'<!--personal:([\w=-]+)-->')
+
+
+def hole(template_name, params):
+    """Метка персональной части страницы вместо её разметки."""
+    raw = json.dumps([template_name, params]).encode()
+    return mark_safe(
+        f'<!--personal:{base64.urlsafe_b64encode(raw).decode()}-->'
+    )
+
+
+def fill_holes(request, body):
+    """Рендерит персональные части на месте меток для этого запроса."""
+    def render_hole(match):
+        template_name, params = json.loads(
+            base64.urlsafe_b64decode(match.group(1))
+        )
+        return render_to_string(template_name, params, request=request)
+
+    return HOLE_PATTERN.sub(render_hole, body)
+
+
+def _current_versions(scopes):
+    """Версии областей; у области без версии — None, ключ не создаётся."""
+    _pending.before_read(scopes)
+    keys = {_version_key(scope): scope for scope in scopes}
+    found = cache.get_many(list(keys))
+    return {scope: found.get(key) for key, scope in keys.items()}
+
+
+def _create_versions(versions):
+    """Заводит версии, которых не завёл `depend_on`, перед записью страницы.
+
+    Версии заводятся только для найденной страницы: 404 по
+    несуществующему имени не оставляет в кэше ключей. Если версию
+    за время рендера завёл кто-то другой, возвращает False: страница
+    могла отрендериться до правки, и кэшировать её нельзя.
+    """
+    for scope, version in versions.items():
+        if version is None:
+            version = _new_version()
+            if not cache.add(_version_key(scope), version, None):
+                return False
+            versions[scope] = version
+    return True
+
+
+def depend_on(request, *scopes):
+    """Отмечает области, от которых зависит страница `shared_cache_page`.
+
+    Версии запоминаются сразу, до рендера: правка во время рендера
+    не попадёт в кэш под новой версией. View зовёт `depend_on`, когда
+    объекты страницы уже нашлись, поэтому здесь же заводятся версии,
+    которых ещё нет, в том числе области самой страницы.
+    """
+    versions = getattr(request, 'page_versions', None)
+    if versions is not None:
+        versions.update(_current_versions(scopes))
+        for scope, version in versions.items():
+            if version is None:
+                versions[scope] = get_version(scope)
+
+
+def _page_key(prefix, request):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'page:{prefix}:{path}'
+
+
+def _is_authenticated(request):
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_authenticated
+
+
+def _anonymous_request(request):
+    anonymous = copy.copy(request)
+    anonymous.user = AnonymousUser()
+    return anonymous
+
+
+def _render_entry(view_func, request, args, kwargs, versions):
+    """Рендерит страницу с метками; возвращает запись для кэша.
+
+    Ответ, который кэшировать нельзя (не 200, потоковый), возвращается
+    как есть.
+    """
+    request.page_versions = versions
+    request.punch_holes = True
+    try:
+        response = view_func(request, *args, **kwargs)
+    finally:
+        request.punch_holes = False
+        versions = request.page_versions
+        del request.page_versions
+    if response.streaming or response.status_code != 200:
+        return response
+    body = response.content.decode(response.charset)
+    return {
+        'versions': versions,
+        'body': body,
+        'anonymous_body': fill_holes(_anonymous_request(request), body),
+        'content_type': response['Content-Type'],
+    }
+
+
+def _personalize(request, result):
+    """Ответ с персональными частями для текущего посетителя."""
+    if not isinstance(result, dict):
+        if not result.streaming:
+            result.content = fill_holes(
+                request, result.content.decode(result.charset)
+            )
+        return result
+    if _is_authenticated(request):
+        body = fill_holes(request, result['body'])
+    else:
+        body = result['anonymous_body']
+    response = HttpResponse(body, content_type=result['content_type'])
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+
+def _refresh_in_background(refresh_key, refresh_deadline, render):
+    """Перерисовывает устаревшую страницу в фоновом потоке.
+
+    Метка `refresh_key` живёт `refresh_deadline` секунд: пока она есть,
+    другие запросы и процессы не запускают второе обновление. Если
+    обновление зависло, по истечении срока его перезапустит новый запрос.
+    """
+    if not cache.add(refresh_key, 1, refresh_deadline):
+        return
+
+    def refresh():
+        try:
+            render()
+        finally:
+            cache.delete(refresh_key)
+            connections.close_all()
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def versioned_cache_page(timeout, scope, stale=0, refresh_deadline=30):
+    """Аналог `cache_page` с версией области в ключе кэша.
+
+    `scope` получает аргументы view и возвращает имя области.
+    Страницы живут `timeout` секунд, но сбрасываются сразу,
+    как только сигналы моделей вызовут `bump_version` для области.
+    Промахи одной страницы склеиваются через `core.singleflight`.
+
+    Кроме того, view может отметить через `depend_on` области
+    авторов и групп со страницы: их правка тоже сбрасывает запись.
+
+    Ещё `stale` секунд после истечения `timeout` страница отдаётся
+    сразу, а фоновый поток перерисовывает её (stale-while-revalidate),
+    тратя на это не больше `refresh_deadline` секунд.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view_func(request, *args, **kwargs)
+            page_scope = scope(*args, **kwargs)
+            version = _current_versions([page_scope])[page_scope]
+
+            def render(request):
+                entry = _render_entry(
+                    view_func, request, args, kwargs, {page_scope: version}
+                )
+                if isinstance(entry, dict) and _create_versions(
+                    entry['versions']
+                ):
+                    entry['fresh_until'] = time.time() + timeout
+                    page_version = entry['versions'][page_scope]
+                    cache.set(
+                        _page_key(f'{page_scope}.{page_version}', request),
+                        entry,
+                        timeout + stale,
+                    )
+                return entry
+
+            if version is None:
+                # Страницу области ещё не кэшировали, или её нет (404):
+                # склеивать нечего.
+                return _personalize(request, render(request))
+            cache_key = _page_key(f'{page_scope}.{version}', request)
+            # Автор или группа с этой страницы могли смениться.
+            entry = _fresh_entry(cache_key)
+            if entry is None:
+                entry = singleflight.coalesce(
+                    cache_key,
+                    lookup=lambda: _fresh_entry(cache_key),
+                    rebuild=lambda: render(request),
+                )
+            elif time.time() >= entry['fresh_until']:
+                # Фоновый рендер получает свою копию запроса.
+                background_request = copy.copy(request)
+                _refresh_in_background(
+                    f'{cache_key}:refresh',
+                    refresh_deadline,
+                    lambda: render(background_request),
+                )
+            return _personalize(request, entry)
+        return wrapper
+    return decorator
+
+
+def _fresh_entry(cache_key):
+    entry = cache.get(cache_key)
+    if entry is None:
+        return None
+    if _current_versions(entry['versions']) != entry['versions']:
+        return None
+    return entry
+
+
+def shared_cache_page(timeout, scope):
+    """Страница, чья запись проверяется по версиям нескольких областей.
+
+    Кроме области `scope` из аргументов view, сама view может отметить
+    через `depend_on` области, которые узнала при рендере (автор,
+    группа). Запись действительна, пока версии всех областей прежние.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view_func(request, *args, **kwargs)
+            page_scope = scope(*args, **kwargs)
+            cache_key = _page_key(page_scope, request)
+
+            def render():
+                entry = _render_entry(
+                    view_func, request, args, kwargs,
+                    _current_versions([page_scope]),
+                )
+                if isinstance(entry, dict) and _create_versions(
+                    entry['versions']
+                ):
+                    cache.set(cache_key, entry, timeout)
+                return entry
+
+            result = _fresh_entry(cache_key)
+            if result is None:
+                if _current_versions([page_scope])[page_scope] is None:
+                    # Как в `versioned_cache_page`: без склейки.
+                    result = render()
+                else:
+                    result = singleflight.coalesce(
+                        cache_key,
+                        lookup=lambda: _fresh_entry(cache_key),
+                        rebuild=render,
+                    )
+            return _personalize(request, result)
+        return wrapper
+    return decorator
@@ -0,0 +1,170 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Page, Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from . import feed_counts
+
+
+class FeedPage(Page):
+    """Страница ленты, которая умеет отдавать курсоры соседних страниц."""
+
+    is_cursor = False
+
+    @property
+    def page_window(self):
+        """Номера страниц вокруг текущей для ссылок пагинатора."""
+        radius = self.paginator.window
+        first = max(1, self.number - radius)
+        last = min(self.paginator.num_pages, self.number + radius)
+        return range(first, last + 1)
+
+    @property
+    def next_cursor(self):
+        if not self.has_next() or not len(self):
+            return None
+        return self.paginator.encode_cursor(self[len(self) - 1])
+
+    @property
+    def previous_cursor(self):
+        if not self.has_previous() or not len(self):
+            return None
+        return self.paginator.encode_cursor(self[0])
+
+
+class CursorPage(FeedPage):
+    """Страница, выбранная по курсору: без OFFSET и без COUNT(*)."""
+
+    is_cursor = True
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        super().__init__(object_list, None, paginator)
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<Cursor page>'
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+
+class CursorPaginator(Paginator):
+    """Пагинатор с режимом курсора по ключу сортировки.
+
+    Курсор — непрозрачный токен со значениями полей `ordering`
+    последней (или первой) записи страницы. Выборка следующей страницы
+    идёт условием по ключу, поэтому её стоимость не зависит от глубины.
+
+    Если задан `count_scope`, число записей берётся из кэшируемого
+    счётчика ленты (см. `posts.feed_counts`), а не из COUNT(*).
+    """
+
+    window = 2
+
+    def __init__(self, object_list, per_page, ordering=('-pub_date', '-id'),
+                 count_scope=None, **kwargs):
+        self.ordering = tuple(ordering)
+        self.fields = [field.lstrip('-') for field in self.ordering]
+        self.count_scope = count_scope
+        super().__init__(
+            object_list.order_by(*self.ordering), per_page, **kwargs
+        )
+
+    @cached_property
+    def count(self):
+        if self.count_scope is None:
+            return self._count_queryset().count()
+        return feed_counts.get_count(
+            self.count_scope, self._count_queryset()
+        )
+
+    def _count_queryset(self):
+        """Лента без аннотаций, которые нужны только для порядка.
+
+        С аннотациями Django считает COUNT(*) через подзапрос с GROUP BY.
+        """
+        queryset = self.object_list.order_by()
+        annotations = queryset.query.annotations.values()
+        if any(annotation.contains_aggregate for annotation in annotations):
+            return queryset
+        queryset.query.annotations.clear()
+        queryset.query.set_annotation_mask(None)
+        return queryset
+
+    def _get_page(self, *args, **kwargs):
+        return FeedPage(*args, **kwargs)
+
+    def encode_cursor(self, obj):
+        values = [str(getattr(obj, field)) for field in self.fields]
+        raw = json.dumps(values).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, token):
+        """Возвращает значения ключа из токена или None для битого токена."""
+        try:
+            padding = '=' * (-len(token) % 4)
+            values = json.loads(base64.urlsafe_b64decode(token + padding))
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            return None
+        if not isinstance(values, list) or len(values) != len(self.fields):
+            return None
+        try:
+            return [
+                self._cursor_field(field).to_python(value)
+                for field, value in zip(self.fields, values)
+            ]
+        except ValidationError:
+            return None
+
+    def _cursor_field(self, name):
+        """Поле модели или аннотации queryset, по которому идёт курсор."""
+        annotation = self.object_list.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        return self.object_list.model._meta.get_field(name)
+
+    def _keyset_filter(self, values, backwards):
+        condition = Q()
+        for position, field in enumerate(self.ordering):
+            descending = field.startswith('-')
+            lookup = 'lt' if descending != backwards else 'gt'
+            name = self.fields[position]
+            step = Q(**{f'{name}__{lookup}': values[position]})
+            for prefix, value in zip(self.fields, values[:position]):
+                step &= Q(**{prefix: value})
+            condition |= step
+        return condition
+
+    def get_cursor_page(self, after=None, before=None):
+        """Страница после курсора `after` или перед курсором `before`.
+
+        Битый или пустой токен даёт первую страницу ленты.
+        """
+        backwards = bool(before) and not after
+        values = self.decode_cursor(before if backwards else after or '')
+        object_list = self.object_list
+        if values is None:
+            backwards = False
+        else:
+            object_list = object_list.filter(
+                self._keyset_filter(values, backwards)
+            )
+        if backwards:
+            object_list = object_list.reverse()
+        rows = list(object_list[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+            return CursorPage(rows, self, has_next=True, has_previous=has_more)
+        return CursorPage(
+            rows, self, has_next=has_more, has_previous=values is not None
+        )
@@ -0,0 +1,72 @@
+"""Сдвиги версий кэша, отложенные до фиксации транзакции.
+
+Версию, сдвинутую до фиксации, другой процесс может прочитать, пока
+база ещё отдаёт прежние строки, и закэшировать их под новой версией.
+Поэтому внутри транзакции изменённые ключи копятся и сдвигаются один
+раз после фиксации. Раньше ключ сдвигается, только если его читает
+сама транзакция: иначе она прочитала бы записи, закэшированные до
+изменения. Вне транзакции ключи сдвигаются сразу.
+"""
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+
+class _Pending:
+    """Ключи, изменённые в текущей транзакции соединения."""
+
+    def __init__(self, changes, stale=()):
+        self.changes = changes
+        # Список on_commit транзакции: после фиксации или отката
+        # соединение заводит новый.
+        self.hooks = None
+        self.keys = set()
+        # Изменённые после последнего сдвига внутри транзакции.
+        self.stale = set(stale)
+
+    def __call__(self):
+        self.changes.bump(self.keys)
+
+
+class PendingChanges:
+    """Откладывает `bump(keys)` до фиксации транзакции."""
+
+    def __init__(self, bump):
+        self.bump = bump
+        self._local = threading.local()
+
+    def _pending(self, using, create=False):
+        connection = connections[using]
+        pending_by_alias = self._local.__dict__.setdefault('pending', {})
+        pending = pending_by_alias.get(using)
+        if pending is not None and pending.hooks is connection.run_on_commit:
+            return pending
+        if not create:
+            return None
+        # Откат до точки сохранения тоже заводит новый список;
+        # несдвинутые ключи прежнего лучше сдвинуть лишний раз,
+        # чем потерять.
+        pending = _Pending(self, pending.stale if pending else ())
+        transaction.on_commit(pending, using=using)
+        pending.hooks = connection.run_on_commit
+        pending_by_alias[using] = pending
+        return pending
+
+    def changed(self, keys, using=None):
+        """Отмечает изменение ключей; вне транзакции сдвигает их сразу."""
+        using = using or DEFAULT_DB_ALIAS
+        if not connections[using].in_atomic_block:
+            self.bump(keys)
+            return
+        pending = self._pending(using, create=True)
+        pending.keys.update(keys)
+        pending.stale.update(keys)
+
+    def before_read(self, keys):
+        """Сдвигает ключи, которые транзакция изменила и теперь читает."""
+        for using in getattr(self._local, 'pending', {}):
+            pending = self._pending(using)
+            stale = pending.stale.intersection(keys) if pending else None
+            if stale:
+                pending.stale -= stale
+                self.bump(stale)
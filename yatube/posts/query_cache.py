@@ -0,0 +1,209 @@
+"""Кэш результатов запросов к моделям, по таблицам.
+
+Кэширование включается явно: `cached_list(queryset)`, `cached_get`
+и `get_object_or_404`. Ключ — хэш скомпилированного SQL с параметрами
+и версии всех таблиц, которые этот SQL читает (включая JOIN
+и подзапросы). Сохранение и удаление моделей с кэшем (сигналы),
+`update()`, `bulk_create()` и `delete()` через `InvalidatingQuerySet`
+сдвигают версию таблицы, и прежние записи больше не находятся.
+Удаление строки сдвигает и таблицы, куда удаление идёт каскадом.
+
+Внутри транзакции результат в кэш не кладётся: он может откатиться,
+а версии изменённых таблиц сдвигаются после фиксации (`posts.pending`).
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import Counter
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, models, transaction
+from django.http import Http404
+
+from . import pending
+
+# Таблицы из FROM и JOIN, в том числе в подзапросах.
+TABLE_PATTERN = re.compile(r'\b(?:FROM|JOIN)\s+["`]?(\w+)["`]?')
+DEFAULT_TIMEOUT = getattr(settings, 'QUERY_CACHE_TIMEOUT', 60 * 5)
+# Время жизни по модели: {'posts.Group': 3600}.
+TIMEOUTS = getattr(settings, 'QUERY_CACHE_TIMEOUTS', {})
+MAX_GET_RESULTS = 2
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _version_key(table):
+    return f'query_version:{table}'
+
+
+def _new_version():
+    # Как и у страниц: вытесненная версия не совпадёт с прежней.
+    return time.time_ns()
+
+
+def _bump(tables):
+    for table in tables:
+        try:
+            cache.incr(_version_key(table))
+        except ValueError:
+            cache.set(_version_key(table), _new_version(), None)
+
+
+_pending = pending.PendingChanges(_bump)
+
+
+def tables_changed(*tables, using=None):
+    """Делает недействительными закэшированные запросы к таблицам."""
+    _pending.changed(tables, using=using)
+
+
+def _cascade_tables(model, seen):
+    seen.add(model._meta.db_table)
+    for relation in model._meta.related_objects:
+        related = relation.related_model
+        if (relation.on_delete is not models.DO_NOTHING
+                and related._meta.db_table not in seen):
+            _cascade_tables(related, seen)
+    return seen
+
+
+def model_changed(model, using=None):
+    tables_changed(model._meta.db_table, using=using)
+
+
+def model_deleted(model, using=None):
+    """Как `model_changed`, но и для таблиц, куда идёт каскад удаления."""
+    tables_changed(*_cascade_tables(model, set()), using=using)
+
+
+def _versions(tables):
+    _pending.before_read(tables)
+    keys = {_version_key(table): table for table in tables}
+    versions = cache.get_many(keys)
+    for key in keys.keys() - versions.keys():
+        cache.add(key, _new_version(), None)
+        versions[key] = cache.get(key)
+    return [versions[key] for key in sorted(keys)]
+
+
+def table_version(table):
+    """Текущая версия таблицы; сдвигается при каждом её изменении."""
+    return _versions([table])[0]
+
+
+def _count(model, name):
+    with _stats_lock:
+        _stats[model._meta.label, name] += 1
+
+
+def stats():
+    """Попадания и промахи по моделям в текущем процессе."""
+    with _stats_lock:
+        result = {}
+        for (label, name), value in _stats.items():
+            result.setdefault(label, {'hits': 0, 'misses': 0})[name] = value
+        return result
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def cached_list(queryset, timeout=None):
+    """Результат запроса списком; из кэша, пока его таблицы не менялись."""
+    model = queryset.model
+    try:
+        compiler = queryset.query.clone().get_compiler(queryset.db)
+        sql, params = compiler.as_sql()
+    except EmptyResultSet:
+        return []
+    tables = set(TABLE_PATTERN.findall(sql))
+    digest = hashlib.md5(
+        f'{queryset.db}:{sql}:{params!r}:{_versions(tables)}'.encode()
+    ).hexdigest()
+    key = f'query:{model._meta.label}:{digest}'
+    result = cache.get(key)
+    if result is not None:
+        _count(model, 'hits')
+        return result
+    _count(model, 'misses')
+    result = list(queryset)
+    if not connections[queryset.db].in_atomic_block:
+        if timeout is None:
+            timeout = TIMEOUTS.get(model._meta.label, DEFAULT_TIMEOUT)
+        cache.set(key, result, timeout)
+    return result
+
+
+def cached_get(queryset, **lookup):
+    """Как `queryset.get(**lookup)`, но через `cached_list`."""
+    model = queryset.model
+    found = cached_list(queryset.filter(**lookup)[:MAX_GET_RESULTS])
+    if not found:
+        raise model.DoesNotExist(
+            f'{model._meta.object_name} matching query does not exist.'
+        )
+    if len(found) > 1:
+        raise model.MultipleObjectsReturned(
+            f'get() returned more than one {model._meta.object_name}'
+        )
+    return found[0]
+
+
+def get_object_or_404(queryset, **lookup):
+    """`django.shortcuts.get_object_or_404` через кэш запросов."""
+    if not isinstance(queryset, models.QuerySet):
+        queryset = queryset._default_manager.all()
+    try:
+        return cached_get(queryset, **lookup)
+    except queryset.model.DoesNotExist:
+        raise Http404(
+            f'No {queryset.model._meta.object_name} matches the given query.'
+        )
+
+
+class InvalidatingQuerySet(models.QuerySet):
+    """QuerySet, массовые изменения которого сбрасывают кэш запросов.
+
+    `save()` и `delete()` экземпляра сбрасывают его сигналами, а `update()`
+    и `bulk_create()` сигналов не шлют. `delete()` сбрасывает кэш всех
+    таблиц, где удалились строки, и не мешает Django удалять их одним
+    запросом, не выбирая (fast delete).
+    """
+
+    def delete(self):
+        with transaction.atomic(using=self.db, savepoint=False):
+            deleted, rows = super().delete()
+            tables = {
+                apps.get_model(label)._meta.db_table
+                for label, count in rows.items() if count
+            }
+            if tables:
+                tables_changed(*tables, using=self.db)
+        return deleted, rows
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def update(self, **kwargs):
+        updated = super().update(**kwargs)
+        if updated:
+            model_changed(self.model, using=self.db)
+        return updated
+
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super().bulk_create(objs, *args, **kwargs)
+        if created:
+            model_changed(self.model, using=self.db)
+        return created
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        super().bulk_update(objs, fields, batch_size=batch_size)
+        if objs:
+            model_changed(self.model, using=self.db)
@@ -0,0 +1,257 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import (counters, feed_counts, follow_graph, negative_cache,
+               page_cache, query_cache, storage, thumbnails, timelines)
+from .models import (Comment, Follow, Group, Post, TimelineEntry, User,
+                     UserCounter)
+
+
+@receiver(pre_save, sender=Post)
+def remember_post_state(sender, instance, **kwargs):
+    """Запоминает прежние группу и картинку поста до сохранения."""
+    # Файл ещё не записан: его закрепит хранилище при сохранении.
+    instance._image_uploaded = bool(
+        instance.image and not instance.image._committed
+    )
+    if instance.pk is None:
+        return
+    old_state = (
+        Post.objects.filter(pk=instance.pk)
+        .values_list('group_id', 'image')
+        .first()
+    )
+    if old_state is not None:
+        instance._old_group_id, instance._old_image = old_state
+
+
+@receiver(post_save, sender=Post)
+def count_saved_post(sender, instance, created, **kwargs):
+    if created:
+        for scope in feed_counts.post_scopes(
+            instance.group_id, instance.author_id
+        ):
+            feed_counts.change_count(scope, 1)
+        return
+    old_group_id = getattr(instance, '_old_group_id', instance.group_id)
+    if old_group_id != instance.group_id:
+        if old_group_id is not None:
+            feed_counts.change_count(
+                feed_counts.group_scope(old_group_id), -1
+            )
+        if instance.group_id is not None:
+            feed_counts.change_count(
+                feed_counts.group_scope(instance.group_id), 1
+            )
+
+
+@receiver(post_delete, sender=Post)
+def count_deleted_post(sender, instance, **kwargs):
+    for scope in feed_counts.post_scopes(
+        instance.group_id, instance.author_id
+    ):
+        feed_counts.change_count(scope, -1)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def expire_post_pages(sender, instance, **kwargs):
+    scopes = [
+        page_cache.index_scope(),
+        page_cache.profile_scope(instance.author.username),
+        page_cache.post_scope(instance.pk),
+    ]
+    if instance.group_id is not None:
+        scopes.append(page_cache.group_scope(instance.group.slug))
+    old_group_id = getattr(instance, '_old_group_id', instance.group_id)
+    if old_group_id not in (None, instance.group_id):
+        old_slug = (
+            Group.objects.filter(pk=old_group_id)
+            .values_list('slug', flat=True)
+            .first()
+        )
+        if old_slug is not None:
+            scopes.append(page_cache.group_scope(old_slug))
+    page_cache.bump_version(*scopes)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def expire_group_pages(sender, instance, **kwargs):
+    page_cache.bump_version(
+        page_cache.group_scope(instance.slug),
+        page_cache.article_group_scope(instance.pk),
+    )
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def expire_post_detail(sender, instance, **kwargs):
+    if instance.post_id is not None:
+        page_cache.bump_version(page_cache.post_scope(instance.post_id))
+
+
+@receiver(post_save, sender=User)
+def expire_author_articles(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    page_cache.bump_version(page_cache.article_author_scope(instance.pk))
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def expire_profile_pages(sender, instance, **kwargs):
+    # Подписчики на профиле автора, подписки — на профиле читателя.
+    page_cache.bump_version(*(
+        page_cache.profile_scope(user.username)
+        for user in (instance.author, instance.user) if user is not None
+    ))
+
+
+@receiver(post_save, sender=Post)
+def fan_out_post(sender, instance, created, **kwargs):
+    if created:
+        timelines.fan_out(instance)
+
+
+@receiver(post_save, sender=Follow)
+def backfill_timeline(sender, instance, created, **kwargs):
+    if created and instance.user_id and instance.author_id:
+        timelines.backfill(instance.user_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Follow)
+def prune_timeline(sender, instance, **kwargs):
+    if instance.user_id and instance.author_id:
+        timelines.prune(instance.user_id, instance.author_id)
+
+
+@receiver(post_save, sender=User)
+def create_user_counters(sender, instance, created, **kwargs):
+    if created:
+        counters.create_for_user(instance.pk)
+
+
+@receiver(post_save, sender=Post)
+def count_author_post(sender, instance, created, **kwargs):
+    if created:
+        counters.change_user(instance.author_id, posts=1)
+
+
+@receiver(post_delete, sender=Post)
+def uncount_author_post(sender, instance, **kwargs):
+    counters.change_user(instance.author_id, posts=-1)
+
+
+@receiver(post_save, sender=Comment)
+def count_comment(sender, instance, created, **kwargs):
+    if created:
+        counters.change_post(instance.post_id, 1)
+
+
+@receiver(post_delete, sender=Comment)
+def uncount_comment(sender, instance, **kwargs):
+    counters.change_post(instance.post_id, -1)
+
+
+@receiver(post_save, sender=Follow)
+def count_follow(sender, instance, created, **kwargs):
+    if created:
+        counters.change_user(instance.author_id, followers=1)
+        counters.change_user(instance.user_id, following=1)
+
+
+@receiver(post_delete, sender=Follow)
+def uncount_follow(sender, instance, **kwargs):
+    counters.change_user(instance.author_id, followers=-1)
+    counters.change_user(instance.user_id, following=-1)
+
+
+@receiver(post_save, sender=Follow)
+def switch_fanout_on_follow(sender, instance, created, **kwargs):
+    # Счётчик подписчиков уже сдвинут в count_follow.
+    if created and instance.author_id is not None:
+        timelines.followers_changed(instance.author_id)
+
+
+@receiver(post_delete, sender=Follow)
+def switch_fanout_on_unfollow(sender, instance, **kwargs):
+    if instance.author_id is not None:
+        timelines.followers_changed(instance.author_id)
+
+
+@receiver(post_save, sender=Follow)
+def add_follow_edge(sender, instance, created, **kwargs):
+    if created:
+        follow_graph.edge_changed(
+            instance.user_id, instance.author_id, added=True
+        )
+
+
+@receiver(post_delete, sender=Follow)
+def remove_follow_edge(sender, instance, **kwargs):
+    follow_graph.edge_changed(
+        instance.user_id, instance.author_id, added=False
+    )
+
+
+@receiver(post_save, sender=Post)
+def pregenerate_thumbnails(sender, instance, created, **kwargs):
+    image = instance.image.name
+    if image and (created or image != getattr(instance, '_old_image', '')):
+        thumbnails.schedule(image)
+
+
+@receiver(post_save, sender=Post)
+def release_replaced_image(sender, instance, created, **kwargs):
+    old_image = getattr(instance, '_old_image', '')
+    if old_image and old_image != instance.image.name:
+        thumbnails.release(old_image)
+
+
+@receiver(post_save, sender=Post)
+def unpin_uploaded_image(sender, instance, **kwargs):
+    if getattr(instance, '_image_uploaded', False):
+        name = instance.image.name
+        transaction.on_commit(lambda: storage.unpin(name))
+
+
+@receiver(post_delete, sender=Post)
+def release_deleted_image(sender, instance, **kwargs):
+    if instance.image:
+        thumbnails.release(instance.image.name)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_save, sender=Follow)
+@receiver(post_save, sender=Group)
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=TimelineEntry)
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=UserCounter)
+def expire_cached_queries(sender, using=None, **kwargs):
+    query_cache.model_changed(sender, using=using)
+
+
+# Строки UserCounter и TimelineEntry удаляются только каскадом
+# и `InvalidatingQuerySet.delete()`, которые сбрасывают кэш сами.
+# Без обработчика post_delete Django удаляет их одним запросом.
+@receiver(post_delete, sender=Comment)
+@receiver(post_delete, sender=Follow)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=User)
+def expire_deleted_queries(sender, using=None, **kwargs):
+    query_cache.model_deleted(sender, using=using)
+
+
+@receiver(post_save, sender=User)
+def mark_existing_profile(sender, instance, **kwargs):
+    negative_cache.exists(negative_cache.PROFILE, instance.username)
+
+
+@receiver(post_save, sender=Post)
+def mark_existing_post(sender, instance, created, **kwargs):
+    if created:
+        negative_cache.exists(negative_cache.POST, instance.pk)
@@ -0,0 +1,113 @@
+"""Хранилище картинок постов с адресацией по содержимому.
+
+Файл хэшируется, пока пишется на диск, и сохраняется под именем
+`<каталог>/ab/cd/<sha256><расширение>`. Одинаковые загрузки получают
+одно и то же имя, поэтому на диске, в миниатюрах и в бэкапах каждая
+картинка хранится один раз. Посты ссылаются на файл по этому имени.
+
+Запись файла и удаление ненужного (`thumbnails.release`) идут под общей
+блокировкой имени. Сохранённый файл ещё и «закреплён» в кэше, пока пост
+со ссылкой на него не зафиксирован: иначе удаление, проверив ссылки
+до фиксации, стёрло бы файл, который только что переиспользовали.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+from core import singleflight
+
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+# Закрепление снимается после фиксации поста; TTL — на случай отката.
+PIN_TIMEOUT = 60 * 60
+
+
+def blob_lock(name):
+    """Блокировка файла `name` для записи и удаления."""
+    return singleflight.KeyLock(f'image-blob:{name}')
+
+
+def _pin_key(name):
+    return f'image-blob:pins:{name}'
+
+
+def pin(name):
+    key = _pin_key(name)
+    if not cache.add(key, 1, PIN_TIMEOUT):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, PIN_TIMEOUT)
+
+
+def unpin(name):
+    try:
+        if cache.incr(_pin_key(name), -1) <= 0:
+            cache.delete(_pin_key(name))
+    except ValueError:
+        pass
+
+
+def is_pinned(name):
+    return bool(cache.get(_pin_key(name)))
+
+
+@deconstructible
+class HashedFileSystemStorage(FileSystemStorage):
+    """FileSystemStorage, который кладёт каждый уникальный файл один раз."""
+
+    def hashed_name(self, directory, digest, extension):
+        shards = [
+            digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH]
+            for i in range(SHARD_DEPTH)
+        ]
+        return os.path.join(directory, *shards, digest + extension.lower())
+
+    def get_available_name(self, name, max_length=None):
+        # Итоговое имя зависит только от содержимого: совпадение имени
+        # означает тот же файл, суффиксы для уникальности не нужны.
+        return name
+
+    def _save(self, name, content):
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1]
+        upload_dir = self.path(directory)
+        os.makedirs(upload_dir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=upload_dir, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+            name = self.hashed_name(directory, digest.hexdigest(), extension)
+            lock = blob_lock(name)
+            lock.acquire()
+            try:
+                self._store(temp_path, self.path(name))
+                pin(name)
+            finally:
+                lock.release()
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return name.replace('\\', '/')
+
+    def _store(self, temp_path, full_path):
+        if os.path.exists(full_path):
+            os.remove(temp_path)
+            return
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.chmod(temp_path, self.file_permissions_mode or 0o644)
+        # Переименование атомарно: параллельная загрузка того же
+        # файла перезапишет блоб идентичным содержимым.
+        os.replace(temp_path, full_path)
+
+
+post_images = HashedFileSystemStorage()
@@ -0,0 +1,50 @@
+from django import template
+from django.template.loader import render_to_string
+
+from posts import follow_graph, page_cache
+from posts.forms import CommentForm
+
+register = template.Library()
+
+
+@register.simple_tag
+def article_version(post):
+    """Версия фрагмента поста для `{% cache %}`.
+
+    Меняется при правке поста, имени автора или названия группы.
+    """
+    author_scope = page_cache.article_author_scope(post.author_id)
+    parts = [
+        post.updated.timestamp() if post.updated else '',
+        page_cache.get_version(author_scope),
+    ]
+    if post.group_id is not None:
+        parts.append(page_cache.get_version(
+            page_cache.article_group_scope(post.group_id)
+        ))
+    return '.'.join(str(part) for part in parts)
+
+
+@register.simple_tag(takes_context=True)
+def personal(context, template_name, **params):
+    """Часть страницы, своя для каждого посетителя.
+
+    Шаблон части видит только `params` и контекст запроса. Когда
+    страница рендерится в общий кэш (`page_cache.shared_cache_page`),
+    вместо разметки выводится метка, которую заполнят при ответе.
+    """
+    request = context.get('request')
+    if getattr(request, 'punch_holes', False):
+        return page_cache.hole(template_name, params)
+    return render_to_string(template_name, params, request=request)
+
+
+@register.simple_tag
+def comment_form():
+    return CommentForm()
+
+
+@register.simple_tag(takes_context=True)
+def is_following(context, author_id):
+    """Подписан ли текущий пользователь на автора (по графу подписок)."""
+    return follow_graph.is_following(context['user'].pk, author_id)
@@ -1,7 +1,18 @@
+import time
+from collections import Counter
+from unittest import mock
+
 from django.core.cache import cache
-from django.test import Client, TestCase
+from django.db import transaction
+from django.db.models.deletion import Collector
+from django.http import Http404, HttpResponse
+from django.template.loader import render_to_string
+from django.test import (Client, RequestFactory, TestCase,
+                         TransactionTestCase)
 from django.urls import reverse
-from posts.models import Post, User
+from posts import counters, page_cache, query_cache
+from posts.models import (Comment, Follow, Group, Post, TimelineEntry,
+                          User)
 
 
 class PostCacheTests(TestCase):
@@ -18,18 +29,423 @@ class PostCacheTests(TestCase):
 
         cls.authorized_client.force_login(cls.user)
 
+    def setUp(self):
+        cache.clear()
+
     def test_cache_index(self):
-        """Проверка хранения и очищения кэша для index."""
+        """Новый пост появляется на index без очистки кэша."""
         response = self.authorized_client.get(reverse('posts:index'))
         posts = response.content
         Post.objects.create(
             text='test_new_post',
             author=self.user,
         )
-        response_old = self.authorized_client.get(reverse('posts:index'))
-        old_posts = response_old.content
-        self.assertEqual(old_posts, posts)
-        cache.clear()
         response_new = self.authorized_client.get(reverse('posts:index'))
         new_posts = response_new.content
-        self.assertNotEqual(old_posts, new_posts)
+        self.assertNotEqual(posts, new_posts)
+        self.assertContains(response_new, 'test_new_post')
+
+    def test_cache_index_stored(self):
+        """Пока посты не меняются через модель, index отдается из кэша."""
+        post = Post.objects.create(
+            text='test_old_post',
+            author=self.user,
+        )
+        response = self.authorized_client.get(reverse('posts:index'))
+        # update() не шлёт сигналов, поэтому версия кэша не меняется
+        Post.objects.filter(pk=post.pk).update(text='test_changed_post')
+        response_old = self.authorized_client.get(reverse('posts:index'))
+        self.assertEqual(response_old.content, response.content)
+        self.assertNotContains(response_old, 'test_changed_post')
+
+    def test_cache_group_and_profile(self):
+        """Удаление поста сразу сбрасывает кэш группы и профиля."""
+        group = Group.objects.create(
+            title='Тестовая Группа',
+            slug='test-slug',
+            description='тестовое описание группы'
+        )
+        post = Post.objects.create(
+            text='test_deleted_post',
+            author=self.user,
+            group=group,
+        )
+        urls = [
+            reverse('posts:group_list', args=[group.slug]),
+            reverse('posts:profile', args=[self.user.username]),
+        ]
+        for url in urls:
+            self.assertContains(self.authorized_client.get(url), post.text)
+        post.delete()
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.authorized_client.get(url)
+                self.assertNotContains(response, post.text)
+
+    def test_follow_expires_both_profiles(self):
+        """Подписка сбрасывает профили и автора, и подписчика."""
+        reader = User.objects.create_user(username='reader')
+        author_url = reverse('posts:profile', args=[self.user.username])
+        reader_url = reverse('posts:profile', args=[reader.username])
+        client = self.guest_client
+        self.assertContains(client.get(author_url), 'Подписчиков: 0')
+        self.assertContains(client.get(reader_url), 'Подписок: 0')
+        Follow.objects.create(user=reader, author=self.user)
+        self.assertContains(client.get(author_url), 'Подписчиков: 1')
+        self.assertContains(client.get(reader_url), 'Подписок: 1')
+
+    def test_stale_page_refreshed_in_background(self):
+        """Устаревшая страница отдаётся сразу и обновляется в фоне."""
+        renders = []
+
+        def view(request):
+            renders.append(1)
+            return HttpResponse(f'render {len(renders)}')
+
+        cached_view = page_cache.versioned_cache_page(
+            0.05, lambda: 'swr-test', stale=60
+        )(view)
+        factory = RequestFactory()
+        self.assertEqual(cached_view(factory.get('/swr/')).content,
+                         b'render 1')
+        time.sleep(0.1)
+
+        stale = cached_view(factory.get('/swr/'))
+        self.assertEqual(stale.content, b'render 1')
+        deadline = time.monotonic() + 5
+        fresh = stale
+        while fresh.content != b'render 2' and time.monotonic() < deadline:
+            time.sleep(0.01)
+            fresh = cached_view(factory.get('/swr/'))
+        self.assertEqual(fresh.content, b'render 2')
+        self.assertEqual(len(renders), 2)
+
+
+class ArticleFragmentCacheTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(
+            username='HasNoName', first_name='Имя', last_name='Фамилия'
+        )
+        cls.group = Group.objects.create(
+            title='Тестовая Группа',
+            slug='test-slug',
+            description='тестовое описание группы'
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.post = Post.objects.create(
+            text='Тестовый текст', author=self.user, group=self.group
+        )
+
+    def render(self):
+        post = Post.objects.get(pk=self.post.pk)
+        return render_to_string(
+            'posts/includes/article.html',
+            {'post': post, 'show_group': True},
+        )
+
+    def test_fragment_is_cached(self):
+        """Повторный рендер поста берётся из кэша фрагментов."""
+        self.render()
+        # update() не меняет дату правки, фрагмент остаётся прежним
+        Post.objects.filter(pk=self.post.pk).update(text='Без сигналов')
+        self.assertIn('Тестовый текст', self.render())
+
+    def test_fragment_invalidation(self):
+        """Фрагмент обновляется при правке поста, автора и группы."""
+        self.render()
+        self.post.text = 'Новый текст'
+        self.post.save()
+        self.assertIn('Новый текст', self.render())
+
+        self.user.first_name = 'Другое'
+        self.user.save()
+        self.assertIn('Другое Фамилия', self.render())
+
+        self.group.title = 'Новая Группа'
+        self.group.save()
+        self.assertIn('Новая Группа', self.render())
+
+
+class PostDetailCacheTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.post = Post.objects.create(text='Тестовый пост', author=cls.author)
+        cls.url = reverse('posts:post_detail', args=[cls.post.pk])
+
+    def setUp(self):
+        cache.clear()
+        self.author_client = Client()
+        self.author_client.force_login(self.author)
+        self.reader_client = Client()
+        self.reader_client.force_login(self.reader)
+
+    def test_one_body_for_every_visitor(self):
+        """Кэш один, а ссылка правки и форма — свои у каждого."""
+        response = self.author_client.get(self.url)
+        self.assertContains(response, 'Изменить пост')
+        self.assertContains(response, 'csrfmiddlewaretoken')
+
+        response = self.reader_client.get(self.url)
+        self.assertTemplateNotUsed(response, 'posts/post_detail.html')
+        self.assertNotContains(response, 'Изменить пост')
+        self.assertContains(response, 'csrfmiddlewaretoken')
+        self.assertContains(response, 'Пользователь: reader')
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertNotContains(response, 'csrfmiddlewaretoken')
+        self.assertNotContains(response, '<!--personal:')
+
+    def test_comment_expires_page(self):
+        """Новый комментарий сразу виден на странице поста."""
+        self.client.get(self.url)
+        self.author_client.post(
+            reverse('posts:add_comment', args=[self.post.pk]),
+            {'text': 'Свежий коммент'},
+        )
+        self.assertContains(self.client.get(self.url), 'Свежий коммент')
+
+    def test_edit_expires_page(self):
+        """Правка поста сразу видна на странице поста."""
+        self.client.get(self.url)
+        self.post.text = 'Исправленный пост'
+        self.post.save()
+        self.assertContains(self.client.get(self.url), 'Исправленный пост')
+
+        # update() не шлёт сигналов: страница остаётся из кэша.
+        Post.objects.filter(pk=self.post.pk).update(text='Тихая правка')
+        self.assertNotContains(self.client.get(self.url), 'Тихая правка')
+
+
+class FeedPersonalPartsTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+        Post.objects.create(text='Тестовый пост', author=cls.author)
+
+    def setUp(self):
+        cache.clear()
+        self.reader_client = Client()
+        self.reader_client.force_login(self.reader)
+
+    def test_header_rendered_per_user(self):
+        """Лента общая, а шапка у каждого своя."""
+        url = reverse('posts:index')
+        response = self.reader_client.get(url)
+        self.assertContains(response, 'Пользователь: reader')
+
+        author_client = Client()
+        author_client.force_login(self.author)
+        response = author_client.get(url)
+        self.assertTemplateNotUsed(response, 'posts/index.html')
+        self.assertContains(response, 'Пользователь: author')
+        self.assertNotContains(response, 'Пользователь: reader')
+
+        response = self.client.get(url)
+        self.assertContains(response, 'Войти')
+        self.assertNotContains(response, 'Пользователь:')
+
+    def test_anonymous_served_from_cache(self):
+        """Аноним получает страницу из кэша без рендера и запросов."""
+        url = reverse('posts:profile', args=[self.author.username])
+        self.reader_client.get(url)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.templates, [])
+        self.assertContains(response, 'Тестовый пост')
+        self.assertNotContains(response, 'Удалить пост')
+        self.assertNotContains(response, '<!--personal:')
+
+
+class FeedRenameTests(TestCase):
+    """Ленты сбрасываются, когда меняются имя автора или название группы."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create_user(
+            username='author', first_name='Старое', last_name='Имя'
+        )
+        cls.group = Group.objects.create(
+            title='Старая группа',
+            slug='test-slug',
+            description='тестовое описание группы',
+        )
+        Post.objects.create(
+            text='Тестовый текст', author=cls.author, group=cls.group
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_feeds_show_new_names(self):
+        """Главная, группа и профиль показывают новые имя и название."""
+        urls = [
+            reverse('posts:index'),
+            reverse('posts:group_list', args=[self.group.slug]),
+            reverse('posts:profile', args=[self.author.username]),
+        ]
+        for url in urls:
+            self.assertContains(self.client.get(url), 'Старое Имя')
+        self.author.first_name = 'Новое'
+        self.author.save()
+        self.group.title = 'Новая группа'
+        self.group.save()
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertContains(response, 'Новое Имя')
+                self.assertNotContains(response, 'Старое Имя')
+        response = self.client.get(reverse('posts:index'))
+        self.assertContains(response, 'Новая группа')
+        self.assertNotContains(response, 'Старая группа')
+
+
+class PageVersionCommitTests(TransactionTestCase):
+    """Версии страниц сдвигаются после фиксации транзакции."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='HasNoName')
+
+    def test_page_rendered_in_transaction_expires_on_commit(self):
+        """Страница, закэшированная до фиксации, после неё обновляется."""
+        url = reverse('posts:index')
+        self.assertNotContains(self.client.get(url), 'test_new_post')
+        key = page_cache._version_key(page_cache.index_scope())
+        version = cache.get(key)
+        with transaction.atomic():
+            Post.objects.create(text='test_new_post', author=self.user)
+            # Другие процессы видят прежнюю версию, пока строки прежние.
+            self.assertEqual(cache.get(key), version)
+            self.assertContains(self.client.get(url), 'test_new_post')
+        self.assertNotEqual(cache.get(key), version)
+        self.assertContains(self.client.get(url), 'test_new_post')
+
+
+class QueryCacheTests(TransactionTestCase):
+    """Кэш запросов сбрасывается сигналами и массовыми изменениями."""
+
+    def setUp(self):
+        cache.clear()
+        query_cache.reset_stats()
+        self.user = User.objects.create_user(username='HasNoName')
+        self.group = Group.objects.create(
+            title='Тестовая Группа',
+            slug='test-slug',
+            description='тестовое описание группы',
+        )
+
+    def test_repeated_lookup_hits_cache(self):
+        """Повторный поиск не ходит в базу, пока таблица не менялась."""
+        with self.assertNumQueries(1):
+            query_cache.cached_get(Group.objects.all(), slug='test-slug')
+        with self.assertNumQueries(0):
+            group = query_cache.cached_get(
+                Group.objects.all(), slug='test-slug'
+            )
+        self.assertEqual(group, self.group)
+        self.assertEqual(
+            query_cache.stats()['posts.Group'], {'hits': 1, 'misses': 1}
+        )
+
+    def test_save_invalidates(self):
+        """Сохранение модели сбрасывает закэшированные запросы к ней."""
+        query_cache.cached_get(Group.objects.all(), slug='test-slug')
+        self.group.title = 'Новое название'
+        self.group.save()
+        group = query_cache.cached_get(Group.objects.all(), slug='test-slug')
+        self.assertEqual(group.title, 'Новое название')
+        self.group.delete()
+        with self.assertRaises(Http404):
+            query_cache.get_object_or_404(Group, slug='test-slug')
+
+    def test_update_of_joined_table_invalidates(self):
+        """update() таблицы из JOIN тоже сбрасывает запрос."""
+        users = User.objects.select_related('counters')
+        counters.for_user(self.user)
+        author = query_cache.cached_get(users, username='HasNoName')
+        self.assertEqual(author.counters.followers, 0)
+        counters.change_user(self.user.pk, followers=1)
+        author = query_cache.cached_get(users, username='HasNoName')
+        self.assertEqual(author.counters.followers, 1)
+
+    def test_transaction_results_not_cached(self):
+        """Прочитанное в транзакции не попадает в кэш: её могут откатить."""
+        with transaction.atomic():
+            query_cache.cached_get(Group.objects.all(), slug='test-slug')
+        with self.assertNumQueries(1):
+            query_cache.cached_get(Group.objects.all(), slug='test-slug')
+
+    def test_change_visible_inside_transaction(self):
+        """Изменение в транзакции видно её же следующим чтениям."""
+        query_cache.cached_get(Group.objects.all(), slug='test-slug')
+        with transaction.atomic():
+            Group.objects.filter(pk=self.group.pk).update(title='Первое')
+            Group.objects.filter(pk=self.group.pk).update(title='Второе')
+            group = query_cache.cached_get(
+                Group.objects.all(), slug='test-slug'
+            )
+            self.assertEqual(group.title, 'Второе')
+            self.group.title = 'Третье'
+            self.group.save()
+            group = query_cache.cached_get(
+                Group.objects.all(), slug='test-slug'
+            )
+            self.assertEqual(group.title, 'Третье')
+
+    def test_delete_bumps_each_table_once(self):
+        """Удаление с каскадом сдвигает версию каждой таблицы один раз."""
+        post = Post.objects.create(text='Тестовый текст', author=self.user)
+        for i in range(3):
+            Comment.objects.create(
+                post=post, author=self.user, text=f'Комментарий {i}'
+            )
+            TimelineEntry.objects.create(
+                user=User.objects.create_user(username=f'reader{i}'),
+                post=post,
+                author=self.user,
+                pub_date=post.pub_date,
+            )
+        bumped = Counter()
+        with mock.patch.object(
+            query_cache._pending, 'bump', side_effect=bumped.update
+        ):
+            post.delete()
+
+        for table in ('posts_post', 'posts_comment', 'posts_timelineentry'):
+            with self.subTest(table=table):
+                self.assertEqual(bumped[table], 1)
+
+    def test_timeline_entries_fast_deleted(self):
+        """Строки ленты удаляются одним запросом и сбрасывают кэш."""
+        self.assertTrue(
+            Collector(using='default').can_fast_delete(
+                TimelineEntry.objects.all()
+            )
+        )
+
+        def entries():
+            return query_cache.cached_list(
+                TimelineEntry.objects.filter(user=self.user)
+            )
+
+        self.assertEqual(entries(), [])
+        post = Post.objects.create(text='Тестовый текст', author=self.user)
+        TimelineEntry.objects.create(
+            user=self.user, post=post, author=self.user,
+            pub_date=post.pub_date,
+        )
+        self.assertEqual(len(entries()), 1)
+        TimelineEntry.objects.filter(user=self.user).delete()
+        self.assertEqual(entries(), [])
@@ -1,16 +1,37 @@
+import hashlib
+import os
 import shutil
 import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
 from django.shortcuts import get_object_or_404
-from django.test import Client, TestCase, override_settings
+from django.template.loader import render_to_string
+from django.test import (Client, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from PIL import Image, ImageSequence
+from posts import images, storage, thumbnails
 from posts.forms import PostForm
 from posts.models import Group, Post, User
 
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
+SMALL_GIF = (
+    b'\x47\x49\x46\x38\x39\x61\x02\x00'
+    b'\x01\x00\x80\x00\x00\x00\x00\x00'
+    b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+    b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+    b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+    b'\x0A\x00\x3B'
+)
+
 
 @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class PostCreateFormTests(TestCase):
@@ -84,7 +105,13 @@ class PostCreateFormTests(TestCase):
         self.assertEqual(last_obj.text, 'Тестовый текст')
         self.assertEqual(last_obj.author, self.user)
         self.assertEqual(last_obj.group, self.group)
-        self.assertTrue(Post.objects.filter(image='posts/small.gif').exists())
+        created = Post.objects.exclude(image='').get()
+        with created.image.open('rb') as image:
+            digest = hashlib.sha256(image.read()).hexdigest()
+        self.assertEqual(
+            created.image.name,
+            f'posts/{digest[:2]}/{digest[2:4]}/{digest}.gif',
+        )
 
     def test_post_edit(self):
         """Валидная форма post_edit создает запись в Post."""
@@ -108,3 +135,327 @@ class PostCreateFormTests(TestCase):
         self.assertEqual(last_obj.text, 'Тестовый текст2')
         self.assertEqual(last_obj.author, self.user)
         self.assertEqual(last_obj.group, None)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class ThumbnailTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='HasNoName')
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def test_generate_thumbnails_command(self):
+        """generate_thumbnails строит миниатюры для картинок постов."""
+        Post.objects.create(
+            text='Тестовый текст',
+            author=self.user,
+            image=SimpleUploadedFile(
+                name='thumb.gif', content=SMALL_GIF, content_type='image/gif'
+            ),
+        )
+        thumbnail_dir = os.path.join(TEMP_MEDIA_ROOT, 'cache')
+        shutil.rmtree(thumbnail_dir, ignore_errors=True)
+
+        out = StringIO()
+        call_command('generate_thumbnails', workers=1, stdout=out)
+
+        self.assertIn('ошибок: 0', out.getvalue())
+        generated = [
+            name for _, _, files in os.walk(thumbnail_dir) for name in files
+        ]
+        self.assertEqual(len(generated), len(thumbnails.THUMBNAIL_SPECS))
+
+    def test_page_thumbnails_batched(self):
+        """Миниатюры страницы находятся одним запросом к хранилищу sorl."""
+        posts = [
+            Post.objects.create(
+                text=f'Тестовый текст {i}',
+                author=self.user,
+                image=SimpleUploadedFile(
+                    name=f'batch{i}.gif',
+                    # Разное содержимое: одинаковые картинки — один файл.
+                    content=SMALL_GIF + bytes([i]),
+                    content_type='image/gif',
+                ),
+            )
+            for i in range(3)
+        ]
+        for post in posts:
+            thumbnails.generate(post.image.name)
+        cache.clear()
+
+        posts = thumbnails.attach(Post.objects.filter(pk__in=[
+            post.pk for post in posts
+        ]))
+        with CaptureQueriesContext(connection) as queries:
+            urls = [post.thumbnail.url for post in posts]
+        self.assertEqual(len(queries), 1)
+        self.assertIn('thumbnail_kvstore', queries[0]['sql'])
+        self.assertEqual(len(set(urls)), 3)
+
+    def test_responsive_markup(self):
+        """Лента отдаёт WebP и srcset с ленивой загрузкой и размерами."""
+        post = Post.objects.create(
+            text='Тестовый текст',
+            author=self.user,
+            image=SimpleUploadedFile(
+                name='responsive.gif',
+                content=SMALL_GIF,
+                content_type='image/gif',
+            ),
+        )
+        thumbnails.generate(post.image.name)
+        [post] = thumbnails.attach([Post.objects.get(pk=post.pk)])
+
+        html = render_to_string(
+            'posts/includes/article.html', {'post': post}
+        )
+        self.assertIn('type="image/webp"', html)
+        self.assertEqual(html.count(' 480w'), 2)
+        self.assertIn('.webp 1440w', html)
+        self.assertIn('loading="lazy"', html)
+        self.assertIn('width="960" height="339"', html)
+
+    def test_generated_variants_reach_cached_feeds(self):
+        """Готовые варианты сбрасывают ленты, закэшированные без них."""
+        group = Group.objects.create(
+            title='Тестовая Группа',
+            slug='test-slug',
+            description='тестовое описание группы',
+        )
+        post = Post.objects.create(
+            text='Тестовый текст',
+            author=self.user,
+            group=group,
+            image=SimpleUploadedFile(
+                name='late.gif',
+                content=SMALL_GIF + b'late',
+                content_type='image/gif',
+            ),
+        )
+        cache.clear()
+        urls = [
+            reverse('posts:index'),
+            reverse('posts:group_list', args=[group.slug]),
+            reverse('posts:profile', args=[self.user.username]),
+            reverse('posts:post_detail', args=[post.pk]),
+        ]
+        for url in urls:
+            self.assertNotContains(self.client.get(url), 'srcset')
+        updated = Post.objects.get(pk=post.pk).updated
+        # Фоновая задача закрывает соединения своего потока.
+        with mock.patch.object(thumbnails.connections, 'close_all'):
+            thumbnails._generate_in_background(post.image.name)
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertContains(self.client.get(url), 'srcset')
+        self.assertEqual(Post.objects.get(pk=post.pk).updated, updated)
+
+    def test_missing_variants_use_original(self):
+        """Без готовых вариантов показывается исходная картинка."""
+        post = Post.objects.create(
+            text='Тестовый текст',
+            author=self.user,
+            image=SimpleUploadedFile(
+                name='original.gif',
+                content=SMALL_GIF,
+                content_type='image/gif',
+            ),
+        )
+        cache.clear()
+        [post] = thumbnails.attach([Post.objects.get(pk=post.pk)])
+        self.assertEqual(post.thumbnail.url, post.image.url)
+        self.assertEqual(post.thumbnail.srcset, '')
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class HashedStorageTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='HasNoName')
+        # Миниатюры здесь не нужны, а фоновая генерация мешает удалению.
+        patcher = mock.patch('posts.thumbnails.schedule')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def create_post(self, name):
+        return Post.objects.create(
+            text='Тестовый текст',
+            author=self.user,
+            image=SimpleUploadedFile(
+                name=name, content=SMALL_GIF, content_type='image/gif'
+            ),
+        )
+
+    def test_same_upload_stored_once(self):
+        """Одинаковые загрузки ссылаются на один файл."""
+        first = self.create_post('first.gif')
+        second = self.create_post('second.GIF')
+
+        self.assertEqual(first.image.name, second.image.name)
+        directory = os.path.dirname(first.image.path)
+        self.assertEqual(os.listdir(directory), [
+            os.path.basename(first.image.path)
+        ])
+
+    def test_last_reference_drops_file(self):
+        """Файл удаляется вместе с последним ссылающимся постом."""
+        first = self.create_post('first.gif')
+        second = self.create_post('second.gif')
+        path = first.image.path
+
+        first.delete()
+        self.assertTrue(os.path.exists(path))
+        second.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_pending_upload_keeps_file(self):
+        """Файл, загруженный для незафиксированного поста, не удаляется."""
+        first = self.create_post('first.gif')
+        path = first.image.path
+        name = storage.post_images.save(
+            'posts/again.gif', SimpleUploadedFile('again.gif', SMALL_GIF)
+        )
+        self.assertEqual(name, first.image.name)
+
+        first.delete()
+        self.assertTrue(os.path.exists(path))
+        second = self.create_post('second.gif')
+        storage.unpin(name)
+        second.delete()
+        self.assertFalse(os.path.exists(path))
+
+
+class ImageNormalizationTests(TestCase):
+
+    def upload(self, size, **save_params):
+        content = BytesIO()
+        Image.new('RGB', size, 'white').save(
+            content, format='JPEG', **save_params
+        )
+        return SimpleUploadedFile(
+            name='photo.jpg',
+            content=content.getvalue(),
+            content_type='image/jpeg',
+        )
+
+    def encode(self, image, name, **save_params):
+        content = BytesIO()
+        image.save(content, **save_params)
+        return SimpleUploadedFile(name=name, content=content.getvalue())
+
+    def clean(self, upload):
+        form = PostForm(data={'text': 'Тестовый текст'}, files={
+            'image': upload,
+        })
+        form.is_valid()
+        return form
+
+    def test_large_image_downscaled_without_metadata(self):
+        """Большая картинка уменьшается и теряет EXIF."""
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera'
+        form = self.clean(self.upload((3000, 1500), exif=exif.tobytes()))
+
+        self.assertTrue(form.is_valid())
+        with Image.open(form.cleaned_data['image']) as image:
+            self.assertEqual(image.size, (images.MAX_SIDE, 1280))
+            self.assertEqual(image.format, 'JPEG')
+            self.assertNotIn('exif', image.info)
+
+    def test_pixel_budget(self):
+        """Картинка больше бюджета пикселей отклоняется."""
+        with mock.patch.object(images, 'MAX_PIXELS', 10_000):
+            form = self.clean(self.upload((200, 100)))
+
+        self.assertFalse(form.is_valid())
+        self.assertIn('image', form.errors)
+
+    def test_tiff_converted_to_browser_mode(self):
+        """CMYK и 16-битные TIFF сохраняются как 8-битный PNG."""
+        cases = {
+            'CMYK': Image.new('CMYK', (40, 20), (0, 255, 255, 0)),
+            'I;16': Image.new('I;16', (40, 20), 40_000),
+        }
+        for mode, source in cases.items():
+            with self.subTest(mode=mode):
+                form = self.clean(
+                    self.encode(source, 'scan.tif', format='TIFF')
+                )
+
+                self.assertTrue(form.is_valid(), form.errors)
+                cleaned = form.cleaned_data['image']
+                self.assertEqual(cleaned.name, 'scan.png')
+                with Image.open(cleaned) as image:
+                    self.assertEqual(image.format, 'PNG')
+                    self.assertIn(image.mode, ('L', 'RGB'))
+
+    def test_camera_mpo_saved_as_jpeg(self):
+        """Снимок MPO сохраняется как JPEG из первого кадра."""
+        upload = self.encode(
+            Image.new('RGB', (3000, 1500), 'white'), 'photo.jpg',
+            format='MPO', save_all=True,
+            append_images=[Image.new('RGB', (160, 80), 'black')],
+        )
+        form = self.clean(upload)
+
+        self.assertTrue(form.is_valid(), form.errors)
+        with Image.open(form.cleaned_data['image']) as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.size, (images.MAX_SIDE, 1280))
+
+    def test_animation_downscaled_without_metadata(self):
+        """Каждый кадр GIF и WebP уменьшается, метаданные пропадают."""
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera'
+        frames = [
+            Image.new('RGB', (3000, 1500), color)
+            for color in ('white', 'black')
+        ]
+        cases = {
+            'GIF': {'comment': b'secret'},
+            'WEBP': {'exif': exif.tobytes()},
+        }
+        for image_format, metadata in cases.items():
+            with self.subTest(format=image_format):
+                form = self.clean(self.encode(
+                    frames[0], f'anim.{image_format.lower()}',
+                    format=image_format, save_all=True,
+                    append_images=frames[1:], duration=[100, 200], loop=0,
+                    **metadata
+                ))
+
+                self.assertTrue(form.is_valid(), form.errors)
+                with Image.open(form.cleaned_data['image']) as image:
+                    self.assertEqual(image.format, image_format)
+                    self.assertEqual(image.n_frames, 2)
+                    self.assertEqual(image.size, (images.MAX_SIDE, 1280))
+                    for name in metadata:
+                        self.assertNotIn(name, image.info)
+                    durations = []
+                    for frame in ImageSequence.Iterator(image):
+                        frame.load()
+                        durations.append(frame.info['duration'])
+                    self.assertEqual(durations, [100, 200])
+
+    def test_pillow_error_rejected(self):
+        """Ошибка Pillow при обработке — ошибка формы, а не 500."""
+        with mock.patch.object(
+            images, '_convert', side_effect=OSError('broken data stream')
+        ):
+            form = self.clean(self.upload((200, 100)))
+
+        self.assertFalse(form.is_valid())
+        self.assertIn('image', form.errors)
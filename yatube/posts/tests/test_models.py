@@ -1,5 +1,8 @@
-from django.test import TestCase
-from posts.models import Group, Post, User
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from posts.models import Comment, Follow, Group, Post, User, UserCounter
 
 
 class PostModelTest(TestCase):
@@ -53,3 +56,71 @@ class PostModelTest(TestCase):
             with self.subTest(field=field):
                 self.assertEqual(
                     post._meta.get_field(field).help_text, expected_value)
+
+
+class CounterTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+
+    def test_counters_follow_changes(self):
+        """Счётчики меняются вместе с постами, комментариями и подписками."""
+        post = Post.objects.create(text='тестовый текст', author=self.author)
+        comment = Comment.objects.create(
+            text='комментарий', author=self.reader, post=post
+        )
+        follow = Follow.objects.create(user=self.reader, author=self.author)
+
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 1)
+        author_counters = UserCounter.objects.get(user=self.author)
+        self.assertEqual(author_counters.posts, 1)
+        self.assertEqual(author_counters.followers, 1)
+        reader_counters = UserCounter.objects.get(user=self.reader)
+        self.assertEqual(reader_counters.following, 1)
+
+        comment.delete()
+        follow.delete()
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 0)
+        author_counters.refresh_from_db()
+        self.assertEqual(author_counters.followers, 0)
+
+    def test_recount_fixes_drift(self):
+        """Команда recount исправляет разошедшиеся счётчики."""
+        post = Post.objects.create(text='тестовый текст', author=self.author)
+        Comment.objects.create(
+            text='комментарий', author=self.reader, post=post
+        )
+        UserCounter.objects.filter(user=self.author).update(posts=42)
+        Post.objects.filter(pk=post.pk).update(comments_count=7)
+
+        call_command('recount', stdout=StringIO())
+
+        self.assertEqual(UserCounter.objects.get(user=self.author).posts, 1)
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 1)
+
+
+class UserDeletionTest(TransactionTestCase):
+    def test_delete_user_with_activity(self):
+        """Удаление пользователя не возвращает его счётчики."""
+        author = User.objects.create_user(username='author')
+        reader = User.objects.create_user(username='reader')
+        post = Post.objects.create(text='тестовый текст', author=author)
+        Post.objects.create(text='второй пост', author=author)
+        Comment.objects.create(text='комментарий', author=reader, post=post)
+        Comment.objects.create(text='ответ', author=author, post=post)
+        Follow.objects.create(user=reader, author=author)
+        Follow.objects.create(user=author, author=reader)
+
+        author.delete()
+
+        self.assertFalse(UserCounter.objects.filter(user_id=author.pk))
+        reader_counters = UserCounter.objects.get(user=reader)
+        self.assertEqual(reader_counters.followers, 0)
+        self.assertEqual(reader_counters.following, 0)
+        reader.delete()
+        self.assertFalse(UserCounter.objects.exists())
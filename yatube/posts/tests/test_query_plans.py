@@ -0,0 +1,86 @@
+import re
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from posts import group_registry
+from posts.models import Comment, Follow, Group, Post, User
+
+# Полный проход по таблице: "SCAN posts_post" без "USING ... INDEX".
+FULL_SCAN = re.compile(r'^SCAN (\S+)$')
+TEMP_SORT = 'USE TEMP B-TREE'
+
+
+class QueryPlanTests(TestCase):
+    """Запросы лент идут по индексам, без полных проходов и сортировок."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.group = Group.objects.create(
+            title='Тестовая Группа',
+            slug='test-slug',
+            description='тестовое описание группы',
+        )
+        Follow.objects.create(user=cls.reader, author=cls.author)
+        cls.posts = [
+            Post.objects.create(
+                text=f'Тестовый текст {i}',
+                author=cls.author,
+                group=cls.group,
+            )
+            for i in range(15)
+        ]
+        Comment.objects.create(
+            post=cls.posts[0], author=cls.reader, text='Коммент'
+        )
+
+    def setUp(self):
+        cache.clear()
+        # Реестр групп читает таблицу целиком, но раз на процесс.
+        group_registry.all_groups()
+        self.client = Client()
+        self.client.force_login(self.reader)
+
+    def query_plan(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[3] for row in cursor.fetchall()]
+
+    def assertIndexed(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        selects = [
+            query['sql'] for query in queries
+            if query['sql'].startswith('SELECT')
+        ]
+        self.assertTrue(selects)
+        for sql in selects:
+            for step in self.query_plan(sql):
+                with self.subTest(url=url, sql=sql, step=step):
+                    self.assertIsNone(FULL_SCAN.match(step))
+                    self.assertNotIn(TEMP_SORT, step)
+
+    def test_feed_queries_use_indexes(self):
+        """Ленты, профиль, пост и подписки обходятся без полных проходов."""
+        urls = [
+            reverse('posts:index'),
+            reverse('posts:index') + '?page=2',
+            reverse('posts:group_list', args=[self.group.slug]),
+            reverse('posts:profile', args=[self.author.username]),
+            reverse('posts:post_detail', args=[self.posts[0].pk]),
+            reverse('posts:follow_index'),
+        ]
+        for url in urls:
+            self.assertIndexed(url)
+
+    def test_cursor_pages_use_indexes(self):
+        """Страницы по курсору тоже идут по индексу ленты."""
+        response = self.client.get(reverse('posts:index'))
+        cursor = response.context['page_obj'].next_cursor
+        self.assertIndexed(reverse('posts:index') + f'?after={cursor}')
+        self.assertIndexed(reverse('posts:index') + f'?before={cursor}')
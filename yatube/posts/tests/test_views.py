@@ -1,16 +1,26 @@
 import shutil
 import tempfile
 from http import HTTPStatus
+from io import StringIO
+from unittest import mock
 
 from django import forms
 from django.conf import settings
-from django.core.cache import cache
+from django.core.cache import cache, caches
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import Http404
 from django.shortcuts import get_object_or_404
-from django.test import Client, TestCase, override_settings
+from django.test import (Client, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from posts import (feed_counts, follow_graph, follows, group_registry,
+                   negative_cache, timelines, views)
 from posts.forms import PostForm
-from posts.models import Follow, Group, Post, User
+from posts.models import (Comment, Follow, Group, Post, TimelineEntry,
+                          User)
 
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
@@ -352,6 +362,10 @@ class PaginatorViewsTest(TestCase):
             ]
         )
 
+    def setUp(self):
+        # bulk_create не шлёт сигналы, счётчики лент считаем заново
+        cache.clear()
+
     def test_first_page_contains(self):
         """Тест Пагинатора для Первой странцы"""
         PAGE_LIMIT = 10
@@ -396,3 +410,533 @@ class PaginatorViewsTest(TestCase):
             with self.subTest(value=value):
                 response = self.client.get(value + '?page=2')
                 self.assertEqual(len(response.context['page_obj']), expected)
+
+    def test_cursor_pages(self):
+        """Курсоры ?after= и ?before= листают ленту без COUNT(*)."""
+        url = reverse('posts:group_list', kwargs={'slug': self.group.slug})
+        first_page = self.client.get(url).context['page_obj']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                url + f'?after={first_page.next_cursor}'
+            )
+        second_page = response.context['page_obj']
+        self.assertEqual(len(second_page), 3)
+        self.assertFalse(second_page.has_next())
+        self.assertTrue(second_page.has_previous())
+        for query in queries:
+            self.assertNotIn('COUNT(', query['sql'])
+
+        response = self.client.get(
+            url + f'?before={second_page.previous_cursor}'
+        )
+        self.assertEqual(
+            list(response.context['page_obj']), list(first_page)
+        )
+
+    def test_broken_cursor_gives_first_page(self):
+        """Битый курсор отдаёт первую страницу ленты."""
+        url = reverse('posts:group_list', kwargs={'slug': self.group.slug})
+        response = self.client.get(url + '?after=broken')
+        page_obj = response.context['page_obj']
+        self.assertEqual(len(page_obj), 10)
+        self.assertFalse(page_obj.has_previous())
+
+    def test_feed_count_is_cached(self):
+        """Число постов ленты берётся из счётчика, а не из COUNT(*)."""
+        url = reverse('posts:group_list', kwargs={'slug': self.group.slug})
+        self.client.get(url)
+        post = Post.objects.create(
+            text='Новый пост', author=self.user, group=self.group
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.context['page_obj'].paginator.count, 14)
+        for query in queries:
+            self.assertNotIn('COUNT(', query['sql'])
+
+        post.delete()
+        response = self.client.get(url)
+        self.assertEqual(response.context['page_obj'].paginator.count, 13)
+
+    def test_page_window(self):
+        """Пагинатор показывает только окно номеров вокруг текущей."""
+        url = reverse('posts:group_list', kwargs={'slug': self.group.slug})
+        response = self.client.get(url + '?page=2')
+        self.assertEqual(
+            list(response.context['page_obj'].page_window), [1, 2]
+        )
+
+
+class FeedCountTransactionTests(TransactionTestCase):
+    """Счётчик ленты меняется только вместе с зафиксированными постами."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='auth')
+        Post.objects.create(text='Первый пост', author=self.user)
+        self.scope = feed_counts.index_scope()
+
+    def count(self):
+        return feed_counts.get_count(self.scope, Post.objects.all())
+
+    def test_rollback_keeps_count(self):
+        """Откат создания поста не сдвигает закэшированный счётчик."""
+        self.assertEqual(self.count(), 1)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Post.objects.create(text='Откатится', author=self.user)
+                # Сама транзакция видит свой пост.
+                self.assertEqual(self.count(), 2)
+                raise RuntimeError
+        self.assertEqual(self.count(), 1)
+        self.assertEqual(cache.get(feed_counts._key(self.scope)), 1)
+
+    def test_commit_changes_count(self):
+        """После фиксации счётчик учитывает новый пост без COUNT(*)."""
+        self.assertEqual(self.count(), 1)
+        with transaction.atomic():
+            Post.objects.create(text='Второй пост', author=self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.count(), 2)
+        self.assertEqual(len(queries), 0)
+
+
+class FollowTimelineTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.old_post = Post.objects.create(
+            text='Старый пост', author=cls.author
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.reader_client = Client()
+        self.reader_client.force_login(self.reader)
+
+    def follow_feed(self):
+        response = self.reader_client.get(reverse('posts:follow_index'))
+        return list(response.context['page_obj'])
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        """Подписка заполняет ленту, отписка её очищает."""
+        self.reader_client.get(
+            reverse('posts:profile_follow', args=[self.author.username])
+        )
+        self.assertEqual(self.follow_feed(), [self.old_post])
+        self.assertTrue(
+            TimelineEntry.objects.filter(user=self.reader).exists()
+        )
+
+        self.reader_client.get(
+            reverse('posts:profile_unfollow', args=[self.author.username])
+        )
+        self.assertEqual(self.follow_feed(), [])
+        self.assertFalse(
+            TimelineEntry.objects.filter(user=self.reader).exists()
+        )
+
+    def test_new_post_fans_out(self):
+        """Новый пост автора сразу попадает в ленты подписчиков."""
+        Follow.objects.create(user=self.reader, author=self.author)
+        new_post = Post.objects.create(text='Новый пост', author=self.author)
+        self.assertEqual(self.follow_feed(), [new_post, self.old_post])
+
+    def test_pull_author_read_on_the_fly(self):
+        """Посты авторов без раскладки подмешиваются при чтении."""
+        with mock.patch.object(timelines, 'FANOUT_LIMIT', 0):
+            Follow.objects.create(user=self.reader, author=self.author)
+            new_post = Post.objects.create(
+                text='Новый пост', author=self.author
+            )
+            self.assertFalse(
+                TimelineEntry.objects.filter(post=new_post).exists()
+            )
+            self.assertEqual(self.follow_feed(), [new_post, self.old_post])
+
+    def test_leaving_pull_mode_backfills(self):
+        """Посты, вышедшие в pull-режиме, остаются в лентах после него."""
+        other = User.objects.create_user(username='other')
+        with mock.patch.object(timelines, 'FANOUT_LIMIT', 1):
+            Follow.objects.create(user=self.reader, author=self.author)
+            Follow.objects.create(user=other, author=self.author)
+            self.assertIn(self.author.pk, timelines.pull_author_ids())
+            pulled = Post.objects.create(text='Pull', author=self.author)
+            self.assertFalse(
+                TimelineEntry.objects.filter(post=pulled).exists()
+            )
+            Follow.objects.filter(user=other).delete()
+            self.assertNotIn(self.author.pk, timelines.pull_author_ids())
+            cache.clear()
+            self.assertNotIn(self.author.pk, timelines.pull_author_ids())
+            self.assertEqual(self.follow_feed(), [pulled, self.old_post])
+
+    def test_rebuild_timelines_command(self):
+        """Команда rebuild_timelines восстанавливает ленты."""
+        Follow.objects.create(user=self.reader, author=self.author)
+        TimelineEntry.objects.all().delete()
+        call_command('rebuild_timelines', stdout=StringIO())
+        self.assertEqual(self.follow_feed(), [self.old_post])
+
+
+class FollowTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reader = User.objects.create_user(username='reader')
+        cls.other = User.objects.create_user(username='other')
+        cls.authors = [
+            User.objects.create_user(username=f'author{i}')
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.reader_client = Client()
+        self.reader_client.force_login(self.reader)
+
+    def test_follow_is_idempotent(self):
+        """Повторная подписка не создаёт дубликатов."""
+        url = reverse('posts:profile_follow', args=['author0'])
+        self.reader_client.get(url)
+        self.reader_client.get(url)
+        self.assertEqual(
+            Follow.objects.filter(
+                user=self.reader, author=self.authors[0]
+            ).count(),
+            1,
+        )
+        self.assertEqual(self.authors[0].counters.followers, 1)
+
+    def test_unfollow_only_own_follow(self):
+        """Отписка снимает только подписку текущего пользователя."""
+        Follow.objects.create(user=self.other, author=self.authors[0])
+        url = reverse('posts:profile_unfollow', args=['author0'])
+        response = self.reader_client.get(url)
+        self.assertEqual(response.status_code, HTTPStatus.FOUND)
+        self.assertTrue(
+            Follow.objects.filter(
+                user=self.other, author=self.authors[0]
+            ).exists()
+        )
+
+    def test_bulk_follow_endpoint(self):
+        """Массовая подписка и отписка возвращают число изменений."""
+        url = reverse('posts:bulk_follow')
+        usernames = ['author0', 'author1', 'author2', 'reader', 'nobody']
+        Follow.objects.create(user=self.reader, author=self.authors[0])
+
+        response = self.reader_client.post(url, {'usernames': usernames})
+        self.assertEqual(response.json()['changed'], 2)
+        self.assertEqual(Follow.objects.filter(user=self.reader).count(), 3)
+
+        response = self.reader_client.post(url, {
+            'usernames': usernames, 'action': 'unfollow',
+        })
+        self.assertEqual(response.json()['changed'], 3)
+        self.assertFalse(Follow.objects.filter(user=self.reader).exists())
+
+        response = self.reader_client.post(url, {'action': 'block'})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_bulk_follow_command(self):
+        """Команда bulk_follow подписывает пачками."""
+        out = StringIO()
+        call_command(
+            'bulk_follow', 'reader', 'author0', 'author1', 'author2',
+            batch_size=2, stdout=out,
+        )
+        self.assertIn('Новых подписок: 3', out.getvalue())
+        self.assertEqual(self.reader.counters.following, 3)
+
+
+class FollowGraphTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reader = User.objects.create_user(username='reader')
+        cls.author = User.objects.create_user(username='author')
+
+    def setUp(self):
+        cache.clear()
+        self.reader_client = Client()
+        self.reader_client.force_login(self.reader)
+
+    def test_graph_follows_signals(self):
+        """Граф меняется вместе с подписками и читается без запросов."""
+        self.assertFalse(
+            follow_graph.is_following(self.reader.pk, self.author.pk)
+        )
+        follows.follow(self.reader, self.author)
+        self.assertTrue(
+            follow_graph.is_following(self.reader.pk, self.author.pk)
+        )
+        self.assertEqual(
+            list(follow_graph.follower_ids(self.author.pk)), [self.reader.pk]
+        )
+        with self.assertNumQueries(0):
+            follow_graph.is_following(self.reader.pk, self.author.pk)
+            follow_graph.follower_ids(self.author.pk)
+
+        follows.unfollow(self.reader, self.author)
+        self.assertFalse(
+            follow_graph.is_following(self.reader.pk, self.author.pk)
+        )
+
+    def test_profile_checks_membership(self):
+        """Профиль не выбирает подписчиков автора ради кнопки."""
+        follows.follow(self.reader, self.author)
+        follow_graph.followee_ids(self.reader.pk)
+        url = reverse('posts:profile', args=[self.author.username])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.reader_client.get(url)
+        self.assertTrue(response.context['following'])
+        self.assertFalse([
+            query for query in queries
+            if 'posts_follow' in query['sql']
+        ])
+
+        response = self.client.get(url)
+        self.assertContains(response, 'Подписаться')
+        self.assertNotContains(response, 'Отписаться')
+
+
+class CommentPageTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.author = User.objects.create_user(username='author')
+        cls.post = Post.objects.create(text='Пост', author=cls.author)
+        cls.commenters = [
+            User.objects.create_user(username=f'reader{i}') for i in range(5)
+        ]
+        total = views.COMMENTS_LIMIT + 5
+        cls.comments = [
+            Comment.objects.create(
+                post=cls.post,
+                author=cls.commenters[i % 5],
+                text=f'Коммент {i}',
+            )
+            for i in range(total)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_post_detail_first_comment_page(self):
+        """На странице поста первая порция комментариев."""
+        response = self.client.get(
+            reverse('posts:post_detail', args=[self.post.pk])
+        )
+        comments = response.context['comments']
+        self.assertEqual(
+            list(comments), self.comments[:views.COMMENTS_LIMIT]
+        )
+        self.assertTrue(comments.has_next())
+        self.assertContains(response, 'Показать ещё комментарии')
+
+    def test_fragment_loads_authors_in_one_query(self):
+        """Фрагмент комментариев не делает запрос на каждого автора."""
+        first = views.comment_page(self.post.pk)
+        url = reverse('posts:post_comments', args=[self.post.pk])
+
+        with self.assertNumQueries(2):
+            response = self.client.get(f'{url}?after={first.next_cursor}')
+        self.assertEqual(
+            list(response.context['comments']),
+            self.comments[views.COMMENTS_LIMIT:],
+        )
+        self.assertNotContains(response, 'Показать ещё комментарии')
+
+    def test_json_comments(self):
+        """JSON-вариант отдаёт комментарии и курсор следующей порции."""
+        url = reverse('posts:post_comments', args=[self.post.pk])
+        data = self.client.get(url, {'format': 'json'}).json()
+        self.assertEqual(len(data['comments']), views.COMMENTS_LIMIT)
+        self.assertEqual(data['comments'][0]['author'], 'reader0')
+
+        data = self.client.get(url, {
+            'format': 'json', 'after': data['next'],
+        }).json()
+        self.assertEqual(len(data['comments']), 5)
+        self.assertIsNone(data['next'])
+
+
+class FeedQueryCountTests(TestCase):
+    """Число запросов на страницу ленты не зависит от числа авторов."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reader = User.objects.create_user(username='reader')
+        cls.group = Group.objects.create(
+            title='Тестовая Группа',
+            slug='test-slug',
+            description='тестовое описание группы',
+        )
+        for i in range(views.PAGE_LIMIT):
+            author = User.objects.create_user(
+                username=f'author{i}', first_name='Имя', last_name=str(i)
+            )
+            Follow.objects.create(user=cls.reader, author=author)
+            Post.objects.create(
+                text=f'Тестовый текст {i}', author=author, group=cls.group
+            )
+
+    def setUp(self):
+        cache.clear()
+        # Реестр групп загружается один раз на процесс, а не на страницу.
+        group_registry.all_groups()
+        self.reader_client = Client()
+        self.reader_client.force_login(self.reader)
+
+    def test_feed_query_count(self):
+        """Авторы приходят запросом постов, группы — из реестра групп."""
+        pages = [
+            (self.client, reverse('posts:index'), 2),
+            (
+                self.client,
+                reverse('posts:group_list', args=[self.group.slug]),
+                2,
+            ),
+            (self.client, reverse('posts:profile', args=['author0']), 3),
+            (self.reader_client, reverse('posts:follow_index'), 5),
+        ]
+        for client, url, queries in pages:
+            with self.subTest(url=url):
+                with self.assertNumQueries(queries):
+                    response = client.get(url)
+                self.assertContains(response, 'Имя 0')
+
+
+class GroupRegistryTests(TestCase):
+    """Группы для формы, страницы группы и лент берутся из реестра."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='HasNoName')
+        cls.group = Group.objects.create(
+            title='Тестовая Группа',
+            slug='test-slug',
+            description='тестовое описание группы',
+        )
+
+    def setUp(self):
+        cache.clear()
+        group_registry.all_groups()
+
+    def test_form_choices_without_queries(self):
+        """Варианты группы в форме поста не требуют запросов."""
+        form = PostForm()
+        with self.assertNumQueries(0):
+            choices = list(form.fields['group'].choices)
+            form.as_p()
+        self.assertEqual(choices[1][1], 'Тестовая Группа')
+        self.assertIsInstance(form.fields['group'], forms.ModelChoiceField)
+
+    def test_group_change_refreshes_registry(self):
+        """Сохранение и удаление группы сразу видны в реестре."""
+        self.group.title = 'Новое название'
+        self.group.save()
+        self.assertEqual(
+            group_registry.by_slug('test-slug').title, 'Новое название'
+        )
+        other = Group.objects.create(title='Другая', slug='other')
+        self.assertEqual(group_registry.get(other.pk), other)
+        other.delete()
+        self.assertIsNone(group_registry.by_slug('other'))
+        response = self.client.get(
+            reverse('posts:group_list', args=['other'])
+        )
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_feed_groups_from_registry(self):
+        """Группа поста в ленте и на странице поста — объект реестра."""
+        post = Post.objects.create(
+            text='Тестовый текст', author=self.user, group=self.group
+        )
+        response = self.client.get(reverse('posts:index'))
+        shown = response.context['page_obj'][0]
+        self.assertIs(shown.group, group_registry.get(self.group.pk))
+        response = self.client.get(
+            reverse('posts:post_detail', args=[post.pk])
+        )
+        self.assertContains(response, 'Тестовая Группа')
+
+
+class NegativeLookupTests(TestCase):
+    """Несуществующие профили и посты отвечают 404 без запросов к базе."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_missing_profile_cached(self):
+        """Повторный запрос чужого имени не ходит в базу."""
+        url = reverse('posts:profile', args=['ghost'])
+        self.assertEqual(
+            self.client.get(url).status_code, HTTPStatus.NOT_FOUND
+        )
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+        User.objects.create_user(username='ghost')
+        self.assertEqual(self.client.get(url).status_code, HTTPStatus.OK)
+
+    def test_missing_post_cached(self):
+        """Промах по id поста запоминается, а новый пост его снимает."""
+        author = User.objects.create_user(username='author')
+        post = Post.objects.create(text='Тестовый текст', author=author)
+        next_id = post.pk + 1
+        url = reverse('posts:post_detail', args=[next_id])
+        self.assertEqual(
+            self.client.get(url).status_code, HTTPStatus.NOT_FOUND
+        )
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        new_post = Post.objects.create(text='Новый пост', author=author)
+        self.assertEqual(new_post.pk, next_id)
+        self.assertEqual(self.client.get(url).status_code, HTTPStatus.OK)
+
+    def test_missing_names_barely_write_cache(self):
+        """Новое имя пишет в кэш только отметку промаха, повтор — ничего."""
+        backend = caches['default']
+        # Версии таблиц для кэша запросов заводит первый же промах.
+        self.client.get(reverse('posts:profile', args=['warm-up']))
+        urls = [
+            reverse('posts:profile', args=['nobody']),
+            reverse('posts:post_detail', args=[10_000]),
+            reverse('posts:post_comments', args=[10_000]),
+        ]
+        for url in urls:
+            with self.subTest(url=url), mock.patch.object(
+                backend, '_write', wraps=backend._write
+            ) as write:
+                self.client.get(url)
+                first = write.call_count
+                self.client.get(url)
+                self.assertLessEqual(first, 1)
+                self.assertEqual(write.call_count, first)
+
+    def test_miss_read_before_creation_is_dropped(self):
+        """Промах, прочитанный до создания объекта, его не скрывает."""
+        negative_cache.exists(negative_cache.PROFILE, 'late')
+
+        def lookup():
+            raise Http404
+
+        with self.assertRaises(Http404):
+            negative_cache.remember_missing(
+                negative_cache.PROFILE, 'late', lookup
+            )
+        self.assertEqual(
+            negative_cache.remember_missing(
+                negative_cache.PROFILE, 'late', lambda: 'found'
+            ),
+            'found',
+        )
@@ -0,0 +1,266 @@
+"""Миниатюры картинок постов.
+
+Для каждой картинки строятся варианты нескольких ширин в WebP и в
+исходном формате (см. `THUMBNAIL_PRESERVE_FORMAT`). Они создаются в пуле
+потоков после сохранения поста, а не во время запроса. Для страницы
+ленты адреса и размеры всех вариантов берутся из хранилища
+sorl-thumbnail одним пакетным запросом (`attach`).
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.utils.functional import SimpleLazyObject
+from sorl.thumbnail import default, delete, get_thumbnail
+from sorl.thumbnail.conf import defaults as sorl_defaults
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.kvstores.cached_db_kvstore import EMPTY_VALUE
+from sorl.thumbnail.kvstores.cached_db_kvstore import KVStore as CachedDBStore
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from core import singleflight
+
+from . import page_cache, storage
+from .models import Post
+
+logger = logging.getLogger(__name__)
+
+# Пропорции ленты 960x339, обрезка по центру.
+FEED_WIDTHS = (480, 960, 1440)
+FEED_WIDTH = 960
+FEED_RATIO = 339 / 960
+FEED_OPTIONS = {'crop': 'center', 'upscale': True}
+FEED_SIZES = '(max-width: 992px) 100vw, 960px'
+WEBP = 'WEBP'
+
+SCHEDULE_GUARD_TIMEOUT = 60
+
+
+def feed_geometry(width):
+    return f'{width}x{round(width * FEED_RATIO)}'
+
+
+THUMBNAIL_SPECS = tuple(
+    (feed_geometry(width), dict(FEED_OPTIONS, **extra))
+    for width in FEED_WIDTHS
+    for extra in ({}, {'format': WEBP})
+)
+
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2),
+    thread_name_prefix='thumbnails',
+)
+
+
+def generate(name):
+    """Строит все варианты миниатюр для файла картинки `name` из MEDIA."""
+    for geometry, options in THUMBNAIL_SPECS:
+        get_thumbnail(name, geometry, **options)
+
+
+def _generate_in_background(name):
+    try:
+        if not default.storage.exists(name):
+            # Последний пост с картинкой удалили раньше, чем дошла очередь.
+            return
+        generate(name)
+        # Фрагменты и страницы с постами с этой картинкой (сам пост,
+        # главная, группа, профиль) отрисуются уже с вариантами. Поле
+        # `updated` не трогаем: это время правки, которое видит автор.
+        page_cache.bump_version(*_page_scopes(
+            Post.objects.filter(image=name).values_list(
+                'pk', 'author_id', 'author__username', 'group__slug'
+            )
+        ))
+    except Exception:
+        logger.exception('Не удалось построить миниатюры для %s', name)
+    finally:
+        cache.delete(_schedule_guard(name))
+        connections.close_all()
+
+
+def _page_scopes(rows):
+    scopes = {page_cache.index_scope()}
+    for post_id, author_id, username, group_slug in rows:
+        scopes.add(page_cache.post_scope(post_id))
+        scopes.add(page_cache.article_author_scope(author_id))
+        scopes.add(page_cache.profile_scope(username))
+        if group_slug is not None:
+            scopes.add(page_cache.group_scope(group_slug))
+    return scopes
+
+
+def _schedule_guard(name):
+    return f'thumbnails:scheduled:{name}'
+
+
+def schedule(name):
+    """Ставит генерацию в пул после фиксации текущей транзакции.
+
+    Повторные вызовы для той же картинки, пока задача не выполнена,
+    ничего не делают.
+    """
+    def submit():
+        if cache.add(_schedule_guard(name), 1, SCHEDULE_GUARD_TIMEOUT):
+            _executor.submit(_generate_in_background, name)
+
+    transaction.on_commit(submit)
+
+
+def release(name):
+    """Удаляет картинку и её миниатюры, если на неё не ссылается ни один пост.
+
+    Проверка идёт после фиксации транзакции, так что откат удаления
+    поста не оставит его без файла. Закреплённый файл (его только что
+    загрузили для ещё не зафиксированного поста) не удаляется.
+    """
+    def drop():
+        lock = storage.blob_lock(name)
+        if not lock.acquire(timeout=singleflight.WAIT_TIMEOUT):
+            # Лишний файл на диске лучше, чем пост без картинки.
+            return
+        try:
+            if storage.is_pinned(name):
+                return
+            if not Post.objects.filter(image=name).exists():
+                delete(name)
+        finally:
+            lock.release()
+
+    transaction.on_commit(drop)
+
+
+def _thumbnail_file(name, geometry, options):
+    """Файл миниатюры с тем же именем, что вычислит `get_thumbnail`."""
+    backend = default.backend
+    source = ImageFile(name)
+    options = dict(options)
+    if sorl_settings.THUMBNAIL_PRESERVE_FORMAT:
+        options.setdefault('format', backend._get_format(source))
+    for key, value in backend.default_options.items():
+        options.setdefault(key, value)
+    for key, attr in backend.extra_options:
+        value = getattr(sorl_settings, attr)
+        if value != getattr(sorl_defaults, attr):
+            options.setdefault(key, value)
+    name = backend._get_thumbnail_filename(source, geometry, options)
+    return ImageFile(name, default.storage)
+
+
+def _lookup_many(files):
+    """Сериализованные записи хранилища sorl для файлов: кэш, затем БД."""
+    kvstore = default.kvstore
+    keys = {add_prefix(image_file.key): image_file for image_file in files}
+    if not isinstance(kvstore, CachedDBStore):
+        return {
+            key: kvstore.get(image_file) for key, image_file in keys.items()
+        }
+    found = kvstore.cache.get_many(list(keys))
+    missing = [key for key in keys if key not in found]
+    if missing:
+        rows = dict(
+            KVStoreModel.objects.filter(key__in=missing)
+            .values_list('key', 'value')
+        )
+        kvstore.cache.set_many(rows, sorl_settings.THUMBNAIL_CACHE_TIMEOUT)
+        found.update(rows)
+    return {
+        key: None if value == EMPTY_VALUE else deserialize_image_file(value)
+        for key, value in found.items()
+    }
+
+
+class ResponsiveImage:
+    """Варианты миниатюры поста для <picture>, srcset и sizes."""
+
+    sizes = FEED_SIZES
+
+    def __init__(self, url, width, height, variants, webp_variants):
+        self.url = url
+        self.width = width
+        self.height = height
+        self.srcset = self._srcset(variants)
+        self.webp_srcset = self._srcset(webp_variants)
+
+    @staticmethod
+    def _srcset(variants):
+        return ', '.join(
+            f'{image.url} {image.width}w' for image in variants
+        )
+
+
+class PageThumbnails:
+    """Миниатюры постов страницы, найденные одним пакетным запросом.
+
+    Варианты, которых ещё нет в хранилище, не строятся в запросе:
+    их генерация ставится в очередь, а в разметку попадают готовые.
+    """
+
+    def __init__(self, posts):
+        self.names = {post.pk: post.image.name for post in posts if post.image}
+        self.files = {
+            (post_id, geometry, options.get('format')): _thumbnail_file(
+                name, geometry, options
+            )
+            for post_id, name in self.names.items()
+            for geometry, options in THUMBNAIL_SPECS
+        }
+        self._images = None
+
+    def _resolve(self):
+        found = _lookup_many(self.files.values())
+        ready = {
+            key: found.get(add_prefix(image_file.key))
+            for key, image_file in self.files.items()
+        }
+        self._images = {}
+        for post_id, name in self.names.items():
+            variants = [
+                ready[post_id, feed_geometry(width), None]
+                for width in FEED_WIDTHS
+            ]
+            webp_variants = [
+                ready[post_id, feed_geometry(width), WEBP]
+                for width in FEED_WIDTHS
+            ]
+            if None in variants or None in webp_variants:
+                schedule(name)
+            fallback = ready[post_id, feed_geometry(FEED_WIDTH), None]
+            if fallback is not None:
+                src = (fallback.url, fallback.width, fallback.height)
+            else:
+                # Миниатюры ещё нет: показываем исходную картинку,
+                # не читая файл ради её размеров.
+                src = (default.storage.url(name), None, None)
+            self._images[post_id] = ResponsiveImage(
+                *src,
+                [image for image in variants if image is not None],
+                [image for image in webp_variants if image is not None],
+            )
+
+    def get(self, post_id):
+        if post_id not in self.names:
+            return None
+        if self._images is None:
+            self._resolve()
+        return self._images[post_id]
+
+
+def attach(posts):
+    """Даёт каждому посту ленивый атрибут `thumbnail`.
+
+    Хранилище sorl опрашивается один раз на всю страницу и только если
+    шаблону действительно понадобилась миниатюра (например, фрагмент
+    поста не нашёлся в кэше).
+    """
+    posts = list(posts)
+    batch = PageThumbnails(posts)
+    for post in posts:
+        post.thumbnail = SimpleLazyObject(
+            lambda post_id=post.pk: batch.get(post_id)
+        )
+    return posts
@@ -0,0 +1,176 @@
+"""Материализованные ленты подписок (fan-out on write).
+
+Новый пост раскладывается в ленты всех подписчиков автора, поэтому
+чтение `follow_index` — один проход по индексу (user, pub_date).
+Авторы с огромным числом подписчиков не раскладываются: их посты
+подмешиваются при чтении (гибридный pull).
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+
+from . import follow_graph
+from .models import Follow, Post, TimelineEntry, UserCounter
+
+FANOUT_LIMIT = getattr(settings, 'TIMELINE_FANOUT_LIMIT', 5000)
+BACKFILL_LIMIT = getattr(settings, 'TIMELINE_BACKFILL_LIMIT', 200)
+BATCH_SIZE = 1000
+
+PULL_AUTHORS_KEY = 'timeline:pull_authors'
+PULL_AUTHORS_TIMEOUT = 60 * 10
+
+TIMELINE_ORDERING = ('-timeline_date', '-timeline_post')
+POST_ORDERING = ('-pub_date', '-id')
+
+
+def pull_author_ids():
+    """Авторы, чьи посты не раскладываются по лентам, а читаются на лету.
+
+    Режим автора определяет денормализованный счётчик подписчиков,
+    а переходы между режимами отмечает `followers_changed`.
+    """
+    author_ids = cache.get(PULL_AUTHORS_KEY)
+    if author_ids is None:
+        author_ids = set(
+            UserCounter.objects.filter(followers__gt=FANOUT_LIMIT)
+            .values_list('user_id', flat=True)
+        )
+        cache.set(PULL_AUTHORS_KEY, author_ids, PULL_AUTHORS_TIMEOUT)
+    return author_ids
+
+
+def _entries(user_ids, posts):
+    return [
+        TimelineEntry(
+            user_id=user_id,
+            post_id=post_id,
+            author_id=author_id,
+            pub_date=pub_date,
+        )
+        for user_id in user_ids
+        for post_id, author_id, pub_date in posts
+    ]
+
+
+def _insert(entries):
+    for start in range(0, len(entries), BATCH_SIZE):
+        TimelineEntry.objects.bulk_create(
+            entries[start:start + BATCH_SIZE], ignore_conflicts=True
+        )
+
+
+def fan_out(post):
+    """Кладёт новый пост в ленты подписчиков автора."""
+    if post.author_id in pull_author_ids():
+        return
+    follower_ids = Follow.objects.filter(
+        author_id=post.author_id
+    ).values_list('user_id', flat=True).distinct()
+    _insert(_entries(
+        follower_ids, [(post.pk, post.author_id, post.pub_date)]
+    ))
+
+
+def _recent_posts(author_id):
+    return list(
+        Post.objects.filter(author_id=author_id)
+        .order_by(*POST_ORDERING)
+        .values_list('id', 'author_id', 'pub_date')[:BACKFILL_LIMIT]
+    )
+
+
+def backfill(user_id, author_id):
+    """Добавляет в ленту свежие посты автора после подписки."""
+    if author_id in pull_author_ids():
+        return
+    _insert(_entries([user_id], _recent_posts(author_id)))
+
+
+def _backfill_followers(author_id):
+    """Раскладывает свежие посты автора по лентам всех подписчиков."""
+    posts = _recent_posts(author_id)
+    if not posts:
+        return
+    follower_ids = list(
+        Follow.objects.filter(author_id=author_id)
+        .values_list('user_id', flat=True)
+    )
+    step = max(1, BATCH_SIZE // len(posts))
+    for start in range(0, len(follower_ids), step):
+        _insert(_entries(follower_ids[start:start + step], posts))
+
+
+def followers_changed(author_id):
+    """Переводит автора в pull-режим и обратно по счётчику подписчиков.
+
+    Посты, вышедшие в pull-режиме, в ленты не попадали: при выходе
+    из него они раскладываются подписчикам, иначе пропадут из лент.
+    """
+    followers = (
+        UserCounter.objects.filter(user_id=author_id)
+        .values_list('followers', flat=True)
+        .first()
+    )
+    if followers is None:
+        return
+    pull_ids = pull_author_ids()
+    is_pull = followers > FANOUT_LIMIT
+    if is_pull == (author_id in pull_ids):
+        return
+    if is_pull:
+        cache.set(
+            PULL_AUTHORS_KEY, pull_ids | {author_id}, PULL_AUTHORS_TIMEOUT
+        )
+        return
+    cache.set(PULL_AUTHORS_KEY, pull_ids - {author_id}, PULL_AUTHORS_TIMEOUT)
+    _backfill_followers(author_id)
+
+
+def prune(user_id, author_id):
+    """Убирает из ленты посты автора после отписки."""
+    TimelineEntry.objects.filter(user_id=user_id, author_id=author_id).delete()
+
+
+def rebuild(user_ids, batch_size=BATCH_SIZE):
+    """Пересобирает ленты пользователей пачками, по транзакции на пачку."""
+    user_ids = list(user_ids)
+    pull_ids = pull_author_ids()
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        follows = (
+            Follow.objects.filter(user_id__in=batch)
+            .exclude(author_id__in=pull_ids)
+            .values_list('user_id', 'author_id')
+            .distinct()
+        )
+        recent = {}
+        entries = []
+        for user_id, author_id in follows:
+            if author_id not in recent:
+                recent[author_id] = _recent_posts(author_id)
+            entries.extend(_entries([user_id], recent[author_id]))
+        with transaction.atomic():
+            TimelineEntry.objects.filter(user_id__in=batch).delete()
+            _insert(entries)
+        yield len(batch)
+
+
+def follow_feed(user):
+    """Queryset ленты подписок и порядок, по которому её листать."""
+    pull_ids = pull_author_ids()
+    followed_pull_ids = pull_ids and [
+        author_id for author_id in follow_graph.followee_ids(user.pk)
+        if author_id in pull_ids
+    ]
+    if not followed_pull_ids:
+        post_list = Post.objects.filter(timeline_entries__user=user).annotate(
+            timeline_date=F('timeline_entries__pub_date'),
+            timeline_post=F('timeline_entries__post_id'),
+        )
+        return post_list, TIMELINE_ORDERING
+    pushed = TimelineEntry.objects.filter(user=user).values('post_id')
+    post_list = Post.objects.filter(
+        Q(id__in=pushed) | Q(author_id__in=followed_pull_ids)
+    )
+    return post_list, POST_ORDERING
@@ -12,6 +12,10 @@ urlpatterns = [
     path('posts/<int:post_id>/edit/', views.post_edit, name='post_edit'),
     path('posts/<int:post_id>/delete', views.post_delete, name='post_delete'),
     path('create/', views.create_post, name='create_post'),
+    path(
+        'posts/<int:post_id>/comments/',
+        views.post_comments,
+        name='post_comments'),
     path(
         'posts/<int:post_id>/comment/',
         views.add_comment,
@@ -20,6 +24,10 @@ urlpatterns = [
         'follow/',
         views.follow_index,
         name='follow_index'),
+    path(
+        'follow/bulk/',
+        views.bulk_follow,
+        name='bulk_follow'),
     path(
         'profile/<str:username>/follow/',
         views.profile_follow,
@@ -1,27 +1,66 @@
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
+from django.db import transaction
+from django.http import HttpResponseBadRequest, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
-from django.views.decorators.cache import cache_page
+from django.views.decorators.http import require_POST
 
+from core.query_budget import query_budget
+
+from . import (counters, feed_counts, follows, group_registry,
+               negative_cache, page_cache, query_cache, thumbnails,
+               timelines)
 from .forms import CommentForm, PostForm
-from .models import Follow, Group, Post, User
+from .models import Comment, Post, User
+from .paginators import CursorPaginator
 
 PAGE_LIMIT = 10
+COMMENTS_LIMIT = 20
+COMMENTS_ORDERING = ('created', 'id')
+BULK_FOLLOW_LIMIT = 1000
+
+
+def cached_feed(scope):
+    return page_cache.versioned_cache_page(
+        settings.PAGE_CACHE_TIMEOUT,
+        scope,
+        stale=settings.PAGE_CACHE_STALE,
+        refresh_deadline=settings.PAGE_CACHE_REFRESH_DEADLINE,
+    )
 
 
-def pagination(request, post_list):
-    paginator = Paginator(post_list, PAGE_LIMIT)
-    page_number = request.GET.get('page')
-    return paginator.get_page(page_number)
+def pagination(request, post_list, count_scope=None,
+               ordering=timelines.POST_ORDERING):
+    paginator = CursorPaginator(
+        post_list, PAGE_LIMIT, ordering=ordering, count_scope=count_scope
+    )
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    if after or before:
+        page_obj = paginator.get_cursor_page(after=after, before=before)
+    else:
+        page_obj = paginator.get_page(request.GET.get('page'))
+    page_obj.object_list = group_registry.attach(
+        thumbnails.attach(page_obj.object_list)
+    )
+    page_cache.depend_on(
+        request, *page_cache.article_scopes(page_obj.object_list)
+    )
+    return page_obj
 
 
-@cache_page(20, key_prefix="index_page")
+@query_budget(queries=6, duplicates=0)
+@cached_feed(page_cache.index_scope)
 def index(request):
     template = 'posts/index.html'
 
-    post_list = Post.objects.select_related("group")
+    post_list = Post.objects.for_feed()
 
-    page_obj = pagination(request=request, post_list=post_list)
+    page_obj = pagination(
+        request=request,
+        post_list=post_list,
+        count_scope=feed_counts.index_scope(),
+    )
 
     context = {
         'page_obj': page_obj,
@@ -30,13 +69,20 @@ def index(request):
     return render(request, template, context)
 
 
+@query_budget(queries=6, duplicates=0)
+@cached_feed(page_cache.group_scope)
 def group_posts(request, slug):
     template = 'posts/group_list.html'
 
-    group = get_object_or_404(Group, slug=slug)
-    post_list = group.posts.all()
+    group = group_registry.get_or_404(slug)
+    page_cache.depend_on(request, page_cache.article_group_scope(group.pk))
+    post_list = group.posts.for_feed()
 
-    page_obj = pagination(request=request, post_list=post_list)
+    page_obj = pagination(
+        request=request,
+        post_list=post_list,
+        count_scope=feed_counts.group_scope(group.pk),
+    )
     context = {
         'group': group,
         'page_obj': page_obj,
@@ -44,34 +90,110 @@ def group_posts(request, slug):
     return render(request, template, context)
 
 
+@query_budget(queries=8, duplicates=1)
+@negative_cache.guard(negative_cache.PROFILE, 'username')
+@cached_feed(page_cache.profile_scope)
 def profile(request, username):
     template = 'posts/profile.html'
 
-    author = get_object_or_404(User, username=username)
-    page_obj = pagination(request=request, post_list=author.posts.all())
+    users = User.objects.select_related('counters')
+    author = negative_cache.remember_missing(
+        negative_cache.PROFILE,
+        username,
+        lambda: query_cache.get_object_or_404(users, username=username),
+    )
+    page_cache.depend_on(
+        request, page_cache.article_author_scope(author.pk)
+    )
+    page_obj = pagination(
+        request=request,
+        post_list=author.posts.for_feed(),
+        count_scope=feed_counts.author_scope(author.pk),
+    )
 
-    following = Follow.objects.filter(author=author)
     context = {
-        'following': following,
         'author': author,
+        'counters': counters.for_user(author),
         'page_obj': page_obj,
     }
     return render(request, template, context)
 
 
+def comment_page(post_id, after=None):
+    """Страница комментариев поста по курсору, с авторами в том же запросе."""
+    paginator = CursorPaginator(
+        Comment.objects.filter(post_id=post_id).select_related('author'),
+        COMMENTS_LIMIT,
+        ordering=COMMENTS_ORDERING,
+    )
+    return paginator.get_cursor_page(after=after)
+
+
+@query_budget(queries=6, duplicates=0)
+@negative_cache.guard(negative_cache.POST, 'post_id')
+@page_cache.shared_cache_page(
+    settings.PAGE_CACHE_TIMEOUT, page_cache.post_scope
+)
 def post_detail(request, post_id):
     template = 'posts/post_detail.html'
-    post = get_object_or_404(Post, id=post_id)
-    comments = post.comments.all()
+    posts = Post.objects.select_related('author__counters')
+    post = negative_cache.remember_missing(
+        negative_cache.POST,
+        post_id,
+        lambda: get_object_or_404(posts, id=post_id),
+    )
+    # Имя автора, его счётчики и название группы тоже есть на странице.
+    scopes = [
+        page_cache.article_author_scope(post.author_id),
+        page_cache.profile_scope(post.author.username),
+    ]
+    if post.group_id is not None:
+        scopes.append(page_cache.article_group_scope(post.group_id))
+    page_cache.depend_on(request, *scopes)
+    thumbnails.attach([post])
+    group_registry.attach([post])
+    comments = comment_page(post.pk, request.GET.get('after'))
     context = {
         'post': post,
-        'form': CommentForm(),
+        'author_counters': counters.for_user(post.author),
         'comments': comments,
     }
     return render(request, template, context)
 
 
+@query_budget(queries=4, duplicates=0)
+@negative_cache.guard(negative_cache.POST, 'post_id')
+def post_comments(request, post_id):
+    """Следующая страница комментариев: HTML-фрагмент или JSON."""
+    negative_cache.remember_missing(
+        negative_cache.POST,
+        post_id,
+        lambda: query_cache.get_object_or_404(
+            Post.objects.only('id'), id=post_id
+        ),
+    )
+    comments = comment_page(post_id, request.GET.get('after'))
+    if request.GET.get('format') != 'json':
+        return render(request, 'posts/includes/comments.html', {
+            'comments': comments,
+            'post_id': post_id,
+        })
+    return JsonResponse({
+        'comments': [
+            {
+                'id': comment.pk,
+                'author': comment.author and comment.author.username,
+                'text': comment.text,
+                'created': comment.created,
+            }
+            for comment in comments
+        ],
+        'next': comments.next_cursor,
+    })
+
+
 @login_required
+@transaction.atomic
 def create_post(request):
     template = 'posts/create_post.html'
     form = PostForm(
@@ -120,6 +242,7 @@ def post_edit(request, post_id):
 
 
 @login_required
+@transaction.atomic
 def post_delete(request, post_id):
     posts = Post.objects.select_related('group')
     post = get_object_or_404(posts, id=post_id)
@@ -130,6 +253,7 @@ def post_delete(request, post_id):
 
 
 @login_required
+@transaction.atomic
 def add_comment(request, post_id):
     post = get_object_or_404(Post, id=post_id)
 
@@ -147,13 +271,14 @@ def add_comment(request, post_id):
     return redirect('posts:post_detail', post_id=post_id)
 
 
+@query_budget(queries=7, duplicates=0)
 @login_required
 def follow_index(request):
-    author_querry = Follow.objects.filter(user=request.user)
-    author_values_list = author_querry.values_list('author')
-    post_list = Post.objects.filter(author_id__in=author_values_list)
+    post_list, ordering = timelines.follow_feed(request.user)
 
-    page_obj = pagination(request=request, post_list=post_list)
+    page_obj = pagination(
+        request=request, post_list=post_list.for_feed(), ordering=ordering
+    )
     context = {
         'page_obj': page_obj
     }
@@ -161,20 +286,41 @@ def follow_index(request):
 
 
 @login_required
+@transaction.atomic
 def profile_follow(request, username):
-    author = get_object_or_404(User, username=username)
-    if author == request.user:
-        return redirect(f'/profile/{username}/')
-    Follow.objects.create(
-        user=request.user,
-        author=author
-    )
+    author = query_cache.get_object_or_404(User, username=username)
+    follows.follow(request.user, author)
     return redirect(f'/profile/{username}/')
 
 
 @login_required
+@transaction.atomic
 def profile_unfollow(request, username):
-    author = get_object_or_404(User, username=username)
-    follow = get_object_or_404(Follow, author=author)
-    follow.delete()
+    author = query_cache.get_object_or_404(User, username=username)
+    follows.unfollow(request.user, author)
     return redirect(f'/profile/{username}')
+
+
+@login_required
+@require_POST
+def bulk_follow(request):
+    """Подписка (action=follow) или отписка (action=unfollow) от авторов.
+
+    Авторы передаются списком `usernames`; пачки по своим транзакциям.
+    """
+    action = request.POST.get('action', 'follow')
+    usernames = request.POST.getlist('usernames')
+    if action not in ('follow', 'unfollow'):
+        return HttpResponseBadRequest('action: follow или unfollow')
+    if len(usernames) > BULK_FOLLOW_LIMIT:
+        return HttpResponseBadRequest(
+            f'Не больше {BULK_FOLLOW_LIMIT} авторов за запрос'
+        )
+    author_ids = User.objects.filter(
+        username__in=usernames
+    ).values_list('pk', flat=True)
+    if action == 'follow':
+        changed = follows.follow_many(request.user, author_ids)
+    else:
+        changed = follows.unfollow_many(request.user, author_ids)
+    return JsonResponse({'action': action, 'changed': changed})
@@ -49,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.query_budget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -143,8 +144,38 @@ MEDIA_URL = '/media/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Варианты миниатюр в исходном формате картинки, а не всегда в JPEG.
+THUMBNAIL_PRESERVE_FORMAT = True
+
+# L1 — LRU в памяти воркера, L2 — общий для воркеров машины SQLite.
+# Значения кэша — pickle: каталог создаётся с правами 0700, чужой
+# каталог не принимается. Тесты берут свой (yatube.test_settings).
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'BACKEND': 'core.cache.TwoTierCache',
+        'LOCATION': os.path.join(CACHE_DIR, 'cache.sqlite3'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+            'L1_MAX_ENTRIES': 1000,
+        },
     }
 }
+SINGLEFLIGHT_LOCK_DIR = os.path.join(CACHE_DIR, 'singleflight')
+
+# Страницы лент сбрасываются сигналами, TTL лишь ограничивает память.
+PAGE_CACHE_TIMEOUT = 60 * 60 * 6
+# Столько секунд после TTL страница отдаётся, пока обновляется в фоне.
+PAGE_CACHE_STALE = 60 * 10
+PAGE_CACHE_REFRESH_DEADLINE = 30
+
+# Время жизни кэша запросов (posts.query_cache) и его значения по моделям.
+QUERY_CACHE_TIMEOUT = 60 * 5
+QUERY_CACHE_TIMEOUTS = {
+    'posts.Group': 60 * 60,
+}
+# Столько секунд помнится, что профиля или поста нет.
+NEGATIVE_CACHE_TIMEOUT = 60 * 10
+
+# Превышение бюджета запросов — ошибка (включено в yatube.test_settings).
+QUERY_BUDGET_STRICT = False
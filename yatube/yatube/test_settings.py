@@ -0,0 +1,27 @@
+"""Настройки для тестов.
+
+    python manage.py test --settings=yatube.test_settings
+
+Каждый запуск получает свой каталог кэша и блокировок: общий смешал бы
+тесты с сервером разработки и параллельными запусками.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+from .settings import *  # noqa: F401,F403
+from .settings import CACHES
+
+CACHE_DIR = tempfile.mkdtemp(prefix='yatube-cache-test-')
+atexit.register(shutil.rmtree, CACHE_DIR, ignore_errors=True)
+CACHES = {
+    'default': dict(
+        CACHES['default'],
+        LOCATION=os.path.join(CACHE_DIR, 'cache.sqlite3'),
+    ),
+}
+SINGLEFLIGHT_LOCK_DIR = os.path.join(CACHE_DIR, 'singleflight')
+
+# В тестах превышение бюджета запросов — ошибка.
+QUERY_BUDGET_STRICT = True